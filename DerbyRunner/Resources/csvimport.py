@@ -0,0 +1,210 @@
+#! /usr/bin/env python
+################################################################################
+##
+##  csvimport.py
+##
+##  Reads vehicle CSV files, one vehicle ID, owner and group per row, on a
+##  background thread so the page stays live and can poll for progress.
+##  Rows are read a chunk at a time and bad rows don't stop the import,
+##  they are collected into one list of errors for a single report.
+##
+################################################################################
+import csv
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+################################################################################
+##
+##  Importer
+##
+##  rows are (uuid, vin, owner, group) tuples, errors (file, line, message)
+##  tuples, file empty for errors found after the files were read. known
+##  is the set of vins already taken, or None when vins don't have to be
+##  unique; a vin is also taken by an earlier row.
+##
+################################################################################
+class Importer(object):
+    CHUNK = 500
+
+    def __init__(self, filenames, known=None):
+        self.filenames = list(filenames)
+        self.seen = None
+        if known is not None:
+            self.seen = set(known)
+
+        self.lock    = threading.Lock()
+        self.thread  = None
+        self.rows    = []
+        self.errors  = []
+        self.count   = 0
+        self.read    = 0
+        self.done    = False
+        self.elapsed = 0.0
+
+        self.size = 0
+        for f in self.filenames:
+            try:
+                self.size += os.path.getsize(f)
+            except OSError:
+                pass
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='Importer')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        start = time.time()
+        try:
+            for f in self.filenames:
+                self.readFile(f)
+        finally:
+            self.elapsed = time.time() - start
+            self.done = True
+
+    # (rows read, bytes read, bytes in all the files)
+    def progress(self):
+        self.lock.acquire()
+        try:
+            return (self.count, self.read, self.size)
+        finally:
+            self.lock.release()
+
+    def readFile(self, filename):
+        try:
+            fh = open(filename, 'rb')
+        except IOError, e:
+            self.commit([], [(filename, 0, "Can't read: %s"%e.strerror)], 0)
+            return
+
+        base = self.read
+        rows = []
+        errors = []
+        try:
+            reader = csv.reader(fh)
+            try:
+                for row in reader:
+                    self.check(filename, reader.line_num, row, rows, errors)
+                    if len(rows) + len(errors) >= self.CHUNK:
+                        self.commit(rows, errors, base + fh.tell())
+                        rows = []
+                        errors = []
+            except csv.Error, e:
+                errors.append((filename, reader.line_num, str(e)))
+            self.commit(rows, errors, base + os.fstat(fh.fileno()).st_size)
+        finally:
+            fh.close()
+
+    def check(self, filename, line, row, rows, errors):
+        if not ''.join(row).strip():
+            return
+        if len(row) != 3:
+            errors.append((filename, line, "Must have Vehicle ID, Owner, and Group"))
+            return
+        (vin, owner, group) = [x.strip() for x in row]
+        if self.seen is not None and vin:
+            if vin in self.seen:
+                errors.append((filename, line, "Vehicle ID %s is already used"%vin))
+                return
+            self.seen.add(vin)
+        rows.append((str(uuid.uuid4()), vin, owner, group))
+
+    def commit(self, rows, errors, read):
+        self.lock.acquire()
+        try:
+            self.rows.extend(rows)
+            self.errors.extend(errors)
+            self.count += len(rows)
+            self.read = read
+        finally:
+            self.lock.release()
+        # Let the page's thread in between chunks
+        time.sleep(0)
+
+    # The errors as one message, at most limit of them listed
+    def report(self, limit=20):
+        txt = ['%d rows skipped:'%len(self.errors)]
+        for (f, line, msg) in self.errors[:limit]:
+            if f:
+                txt.append('%s:%d: %s'%(os.path.basename(f), line, msg))
+            else:
+                txt.append(msg)
+        if len(self.errors) > limit:
+            txt.append('... and %d more'%(len(self.errors) - limit))
+        return '\n'.join(txt)
+
+################################################################################
+##
+##  TC_Importer
+##
+################################################################################
+class TC_Importer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, lines):
+        filename = os.path.join(self.dir, name)
+        fh = open(filename, 'wb')
+        fh.write('\r\n'.join(lines) + '\r\n')
+        fh.close()
+        return filename
+
+    def load(self, filenames, known=None):
+        imp = Importer(filenames, known)
+        imp.start()
+        imp.thread.join()
+        self.assertTrue(imp.done)
+        return imp
+
+    def test_rows(self):
+        f = self.write('a.csv', ['"T001","Rhodes, Patrick","Tiger"',
+                                 '',
+                                 'O001, Manning , Open',
+                                 'W001,Sears'])
+        imp = self.load([f])
+        self.assertEqual([row[1:] for row in imp.rows],
+                [('T001', 'Rhodes, Patrick', 'Tiger'), ('O001', 'Manning', 'Open')])
+        self.assertEqual(len(set([row[0] for row in imp.rows])), 2)
+        self.assertEqual(imp.errors, [(f, 4, "Must have Vehicle ID, Owner, and Group")])
+        self.assertEqual(imp.progress(), (2, os.path.getsize(f), os.path.getsize(f)))
+
+    def test_duplicates(self):
+        a = self.write('a.csv', ['T001,a,Tiger', 'T002,b,Tiger', 'T001,c,Tiger'])
+        b = self.write('b.csv', ['T003,d,Open', 'T002,e,Open', 'X001,f,Open'])
+        imp = self.load([a, b], known=set(['X001']))
+        self.assertEqual([row[1] for row in imp.rows], ['T001', 'T002', 'T003'])
+        self.assertEqual([(f, line) for (f, line, msg) in imp.errors], [(a, 3), (b, 2), (b, 3)])
+        self.assertEqual(len(self.load([a, b]).rows), 6)
+
+    def test_chunks(self):
+        lines = ['C%05d,owner %d,group %d'%(n, n, n % 4) for n in range(0, 2 * Importer.CHUNK + 7)]
+        lines[Importer.CHUNK] = 'bad'
+        imp = self.load([self.write('big.csv', lines)], known=set())
+        self.assertEqual(len(imp.rows), len(lines) - 1)
+        self.assertEqual([line for (f, line, msg) in imp.errors], [Importer.CHUNK + 1])
+
+    def test_report(self):
+        imp = self.load([os.path.join(self.dir, 'none.csv')] +
+                [self.write('x.csv', ['bad'] * 30)])
+        txt = imp.report(limit=5).split('\n')
+        self.assertEqual(txt[0], '31 rows skipped:')
+        self.assertTrue(txt[1].startswith("none.csv:0: Can't read"))
+        self.assertEqual(txt[2], 'x.csv:1: Must have Vehicle ID, Owner, and Group')
+        self.assertEqual(txt[-1], '... and 26 more')
+
+##############################################################################
+##
+##  main
+##
+##############################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,15 @@
 from ConfigParser import SafeConfigParser
 from htmltags import *
 import ppngen
+import ppnatlas
+import ppncache
+import ppnopt
+import ppnsearch
+import csvimport
+import derbydata
+import htmlpatch
+import standings
+import bisect
 import operator
 import optparse
 import os
@@ -8,13 +17,20 @@ import os.path
 import re
 import subprocess
 import sys
+import threading
 import time
-import csv
+import collections
 import uuid
 
 RESDIR = str(Titanium.Filesystem.getResourcesDirectory())
 APPDIR = str(Titanium.Filesystem.getApplicationDataDirectory())
 CFGFILE = os.path.join(APPDIR, 'derby.cfg')
+ATLASFILE = os.path.join(RESDIR, 'ppnatlas.bin')
+HEATFILE = os.path.join(APPDIR, 'heats.db')
+GENSFILE = os.path.join(APPDIR, 'gens.db')
+EVENTFILE = os.path.join(APPDIR, 'event.db')
+EXPORTFILE = os.path.join(APPDIR, 'event.cfg')
+SETTINGSFILE = os.path.join(APPDIR, 'settings.db')
 
 tri_asc = '&#x25B4;'
 tri_dsc = '&#x25BE;'
@@ -33,20 +49,111 @@ class Logger(object):
     INFO     = Titanium.API.INFO
     DEBUG    = Titanium.API.DEBUG
 
-    def fatal(self, msg):
-        Titanium.API.log(Titanium.API.FATAL, str(msg))
-    def critical(self, msg):
-        Titanium.API.log(Titanium.API.CRITICAL, str(msg))
-    def error(self, msg):
-        Titanium.API.log(Titanium.API.ERROR, str(msg))
-    def warn(self, msg):
-        Titanium.API.log(Titanium.API.WARN, str(msg))
-    def notice(self, msg):
-        Titanium.API.log(Titanium.API.NOTICE, str(msg))
-    def info(self, msg):
-        Titanium.API.log(Titanium.API.INFO, str(msg))
-    def debug(self, msg):
-        Titanium.API.log(Titanium.API.DEBUG, str(msg))
+    LEVELS = {
+        'FATAL'    : FATAL,
+        'CRITICAL' : CRITICAL,
+        'ERROR'    : ERROR,
+        'WARN'     : WARN,
+        'NOTICE'   : NOTICE,
+        'INFO'     : INFO,
+        'DEBUG'    : DEBUG,
+    }
+
+    # Seconds messages are collected before they're written out
+    DELAY = 0.2
+
+    # Messages below level are dropped before anything is formatted. The
+    # rest are formatted as they're logged, so an argument that changes
+    # later is logged as it was, and buffered. Titanium.API.log is only
+    # called on the page thread, the one that made the Logger: a message
+    # there sets a timer to write out the buffer. Other threads can't set
+    # one, the page calls poll() for their messages while they work. The
+    # buffer holds the last size messages, older ones are counted and
+    # dropped. ERROR and worse on the page thread are written out at once.
+    #
+    # level is one of the levels or its name. Anything else logs at NOTICE,
+    # with a warning.
+    def __init__(self, level=NOTICE, size=1024):
+        self.level     = self.LEVELS.get(str(level).upper(), level)
+        self.buffer    = collections.deque(maxlen=size)
+        self.dropped   = 0
+        self.lock      = threading.Lock()
+        self.thread    = threading.currentThread()
+        self.scheduled = False
+        if self.level not in self.LEVELS.values():
+            self.level = Logger.NOTICE
+            self.warn("Unknown log level %r, using NOTICE", level)
+
+    def enabled(self, level):
+        return level <= self.level
+
+    def log(self, level, msg, *args):
+        if level > self.level:
+            return
+        try:
+            if args:
+                msg = msg%args
+            else:
+                msg = str(msg)
+        except (TypeError, ValueError), e:
+            msg = '%r %r (%s)'%(msg, args, e)
+        self.lock.acquire()
+        try:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append((level, msg))
+        finally:
+            self.lock.release()
+
+        if threading.currentThread() is not self.thread:
+            return
+        if level <= Logger.ERROR:
+            self.flush()
+        else:
+            self.poll()
+
+    # Sets the timer to write out the buffer if there's anything in it. The
+    # page thread calls it while another thread is at work, so what that
+    # thread logs gets written out.
+    def poll(self):
+        if threading.currentThread() is not self.thread:
+            return
+        if self.buffer and not self.scheduled:
+            self.scheduled = True
+            window.setTimeout(self.flush, self.DELAY * 1000)
+
+    def fatal(self, msg, *args):
+        self.log(Logger.FATAL, msg, *args)
+    def critical(self, msg, *args):
+        self.log(Logger.CRITICAL, msg, *args)
+    def error(self, msg, *args):
+        self.log(Logger.ERROR, msg, *args)
+    def warn(self, msg, *args):
+        self.log(Logger.WARN, msg, *args)
+    def notice(self, msg, *args):
+        self.log(Logger.NOTICE, msg, *args)
+    def info(self, msg, *args):
+        self.log(Logger.INFO, msg, *args)
+    def debug(self, msg, *args):
+        self.log(Logger.DEBUG, msg, *args)
+
+    # Writes out the buffer, on the page thread only
+    def flush(self):
+        if threading.currentThread() is not self.thread:
+            return
+        self.lock.acquire()
+        try:
+            self.scheduled = False
+            (messages, dropped) = (list(self.buffer), self.dropped)
+            self.buffer.clear()
+            self.dropped = 0
+        finally:
+            self.lock.release()
+
+        if dropped:
+            Titanium.API.log(Logger.WARN, 'Logger dropped %d messages'%dropped)
+        for (level, msg) in messages:
+            Titanium.API.log(level, msg)
 
 ################################################################################
 ##
@@ -54,18 +161,35 @@ class Logger(object):
 ##
 ################################################################################
 class Vehicle(object):
-    __slots__ = ('uuid', 'vin', 'owner', 'group')
-
-    def __init__(self, vin='', owner='', group=''):
-        self.uuid  = str(uuid.uuid4())
-        self.vin   = vin
-        self.owner = owner
-        self.group = group
-        log.notice("New vehicle uuid=%s"%self.uuid)
+    __slots__ = ('uuid', '_vin', 'owner', '_group', 'cfg')
+    SECTION = '[VEHICLE]'
+
+    # The fields Config indexes. They're read-only, and once the vehicle is
+    # in a config, config() changes them through it so the indexes follow.
+    INDEXED = ('vin', 'group')
+    FIELDS  = ('vin', 'owner', 'group')
+
+    # uid is given when loading a saved vehicle
+    def __init__(self, vin='', owner='', group='', uid=None):
+        self._vin   = vin
+        self.owner  = owner
+        self._group = group
+        if uid is None:
+            uid = str(uuid.uuid4())
+        self.uuid   = uid
+        self.cfg    = None
+
+    def _fget_vin(self):
+        return self._vin
+    vin = property(fget=_fget_vin)
+
+    def _fget_group(self):
+        return self._group
+    group = property(fget=_fget_group)
 
     def __str__(self):
         txt = []
-        txt.append('[VEHICLE]')
+        txt.append(self.SECTION)
         txt.append('uuid = %s'%(self.uuid,))
         txt.append('vin = %s'%(self.vin,))
         txt.append('owner = %s'%(self.owner,))
@@ -77,10 +201,17 @@ class Vehicle(object):
                 self.uuid, self.vin, self.owner, self.group)
 
     def config(self, key, val):
-        try:
-            self.__setattr__(key, val)
-        except AttributeError:
+        if key in Vehicle.INDEXED and self.cfg is not None:
+            return self.cfg.update(self, key, val)
+        return self.set(key, val)
+
+    # Sets a field as it is, for Config
+    def set(self, key, val):
+        if key not in Vehicle.FIELDS:
             return False
+        if key in Vehicle.INDEXED:
+            key = '_' + key
+        setattr(self, key, val)
         return True
 
 ################################################################################
@@ -106,33 +237,56 @@ class VehicleSort(object):
             GRP_DN : ('group', True),
         }
 
-    def _fget_sorted(self):
-        known = set([x.uuid for x in self._sorted])
-        uuids = set(self.cfg.vehicles.keys())
-        add = uuids - known
-        rem = known - uuids
-        for i in reversed(range(0,len(self._sorted))):
-            if self._sorted[i].uuid in rem:
-                del self._sorted[i]
-        for uuid in add:
-            self._sorted.append(self.cfg.vehicles[uuid])
-        return self._sorted
-    sorted = property(fget=_fget_sorted)
-
     def __init__(self, cfg, render):
         self.cfg     = cfg
         self.render  = render
         self.order   = self.SortOrder.VIN_UP
-        self._sorted = []
-        dummy = self.sorted
-        self.sort()
+
+        # (key, vin, uuid) lists by attribute, ascending, each built when
+        # its order is first shown and kept sorted from the config's events.
+        # Equal keys go by vin, and only then by the random uuid. entries
+        # holds the entry each vehicle was filed under.
+        self.indexes = {}
+        self.entries = {}
+        cfg.listen(self.changed)
+
+    def entry(self, v, attr):
+        return (getattr(v, attr), v.vin, v.uuid)
+
+    def index(self, attr):
+        if attr not in self.indexes:
+            entries = dict([(uid, self.entry(v, attr)) for (uid, v) in self.cfg.vehicles.iteritems()])
+            self.entries[attr] = entries
+            self.indexes[attr] = sorted(entries.values())
+        return self.indexes[attr]
+
+    def changed(self, event, obj, key=None):
+        if event == Config.RESET:
+            # Rebuilt when next shown
+            self.indexes = {}
+            self.entries = {}
+            return
+        if not isinstance(obj, Vehicle):
+            return
+        for (attr, index) in self.indexes.iteritems():
+            entries = self.entries[attr]
+            # A new vin moves the vehicle among its ties in every index
+            if event == Config.UPDATED and key not in (attr, 'vin'):
+                continue
+            if event != Config.ADDED and obj.uuid in entries:
+                old = entries.pop(obj.uuid)
+                i = bisect.bisect_left(index, old)
+                if i < len(index) and index[i] == old:
+                    del index[i]
+            if event != Config.REMOVED:
+                entries[obj.uuid] = self.entry(obj, attr)
+                bisect.insort(index, entries[obj.uuid])
 
     def toggle_vin(self):
         if self.order == self.SortOrder.VIN_UP:
             self.order = self.SortOrder.VIN_DN
         else:
             self.order = self.SortOrder.VIN_UP
-        self.sort()
         self.render()
 
     def toggle_own(self):
@@ -140,7 +294,6 @@ class VehicleSort(object):
             self.order = self.SortOrder.OWN_DN
         else:
             self.order = self.SortOrder.OWN_UP
-        self.sort()
         self.render()
 
     def toggle_grp(self):
@@ -148,12 +301,119 @@ class VehicleSort(object):
             self.order = self.SortOrder.GRP_DN
         else:
             self.order = self.SortOrder.GRP_UP
-        self.sort()
         self.render()
 
-    def sort(self):
+    def __len__(self):
+        return len(self.cfg.vehicles)
+
+    # Vehicles lo to hi in the current order, straight from the index
+    def slice(self, lo, hi):
         (attr, rev) = self.SortOrder.parms[self.order]
-        self._sorted.sort(key=operator.attrgetter(attr), reverse=rev)
+        index = self.index(attr)
+        if rev:
+            n = len(index)
+            part = index[max(0, n - hi):max(0, n - lo)]
+            part.reverse()
+        else:
+            part = index[lo:hi]
+        vehicles = self.cfg.vehicles
+        return [vehicles[uid] for (key, vin, uid) in part]
+
+################################################################################
+##
+##  VehicleWindow
+##
+##  Shows a VehicleSort in a scrolling DIV, rendering only the rows in view
+##  and OVERSCAN more either side. Spacer rows stand in for the rest so the
+##  scrollbar still covers every vehicle. Scrolling re-renders the page,
+##  which contentView turns into removing the rows that left the window
+##  and inserting the ones that came in.
+##
+################################################################################
+class VehicleWindow(object):
+    ROWS     = 20
+    OVERSCAN = 10
+
+    # Row height, as set for div.window in derby.css. The header and the
+    # rows are measured once they're shown, this is only until then.
+    ROW_PX   = 26
+
+    # name is the global the DIV's onscroll handler calls
+    def __init__(self, name, sort, page):
+        self.name     = name
+        self.sort     = sort
+        self.page     = page
+        self.first    = 0
+        self.headerPx = self.ROW_PX
+        self.rowPx    = self.ROW_PX
+
+    def bounds(self):
+        n = len(self.sort)
+        first = max(0, min(self.first, n - self.ROWS))
+        return (max(0, first - self.OVERSCAN), min(n, first + self.ROWS + self.OVERSCAN))
+
+    # header is the TR of column headings and row(v) makes a vehicle's TR
+    def table(self, header, row, cols):
+        (lo, hi) = self.bounds()
+        div = DIV(id=self.name, Class="window", onscroll="%s.scroll(this)"%self.name)
+        tbl = TABLE()
+        tbl <= header
+        tbl <= self.spacer('top', lo, cols)
+        for v in self.sort.slice(lo, hi):
+            tbl <= row(v)
+        tbl <= self.spacer('end', len(self.sort) - hi, cols)
+        div <= tbl
+        return div
+
+    def spacer(self, which, rows, cols):
+        if rows:
+            style = "height: %dpx"%(rows * self.rowPx)
+        else:
+            style = "display: none"
+        return TR(id="%s-%s"%(self.name, which), style=style) <= TD(colspan=str(cols))
+
+    # The vehicle at the top of the DIV when it's scrolled to top, and the
+    # other way around. The header row is above the first vehicle.
+    def rowAt(self, top):
+        return max(0, top - self.headerPx) / self.rowPx
+
+    def topOf(self, first):
+        if not first:
+            return 0
+        return self.headerPx + first * self.rowPx
+
+    def scroll(self, this):
+        first = self.rowAt(int(this.scrollTop))
+        if abs(first - self.first) < self.OVERSCAN / 2:
+            return
+        self.first = first
+        self.page.render()
+
+    # Takes the header and row heights from the table as it's shown, and
+    # returns True if they changed
+    def measure(self, div):
+        rows = div.getElementsByTagName('tr')
+        if rows.length < 3:
+            return False
+        # The header, the top spacer, then the vehicles
+        (headerPx, rowPx) = (int(rows.item(0).offsetHeight), int(rows.item(2).offsetHeight))
+        if headerPx <= 0 or rowPx <= 0 or (headerPx, rowPx) == (self.headerPx, self.rowPx):
+            return False
+        (self.headerPx, self.rowPx) = (headerPx, rowPx)
+        return True
+
+    # A full render replaces the DIV, which starts at the top, so it's
+    # scrolled back to self.first. Spacers sized with the wrong row height
+    # are rendered again.
+    def restore(self):
+        div = document.getElementById(self.name)
+        if div is None:
+            return
+        if self.measure(div):
+            self.page.render()
+            return
+        if self.rowAt(int(div.scrollTop)) != self.first:
+            div.scrollTop = self.topOf(self.first)
 
 ################################################################################
 ##
@@ -161,8 +421,14 @@ class VehicleSort(object):
 ##
 ################################################################################
 class Race(object):
-    __slots__ = ('uuid', 'title', '_lanes', 'vehicles', 'standings', 'heats',
-            'balanceHeats', 'avoidConsecutiveHeats', 'avoidConsecutiveLanes')
+    __slots__ = ('uuid', 'title', '_lanes', '_rounds', 'vehicles', 'standings', 'heats',
+            'balanceHeats', 'avoidConsecutiveHeats', 'avoidConsecutiveLanes',
+            '_entrants', '_pending')
+    SECTION = '[RACE]'
+
+    # Seconds spent improving the greedy heat order when the Improve Heat
+    # Order setting is on
+    OPTIMIZE = 1.0
 
     def _fset_lanes(self, lanes):
         self.heats = None
@@ -174,33 +440,49 @@ class Race(object):
         return self._lanes
     lanes = property(fset=_fset_lanes, fget=_fget_lanes)
 
-    def __init__(self, title='', lanes=6):
-        self.uuid  = str(uuid.uuid4())
+    def _fset_rounds(self, rounds):
+        self.heats = None
+        self._rounds = int(rounds)
+        if not (1 <= self._rounds <= 4):
+            log.warn("Bad number of rounds, defaulting to 1")
+            self._rounds = 1
+    def _fget_rounds(self):
+        return self._rounds
+    rounds = property(fset=_fset_rounds, fget=_fget_rounds)
+
+    # uid is given when loading a saved race
+    def __init__(self, title='', lanes=6, rounds=1, uid=None):
+        if uid is None:
+            uid = str(uuid.uuid4())
+            log.debug("New race uuid=%s", uid)
+        self.uuid  = uid
         self.title = title
         self.lanes = lanes
+        self.rounds = rounds
         self.vehicles = set()
-        log.notice("New race uuid=%s"%self.uuid)
 
         self.standings = None
         self.heats     = None
+        self._entrants = None
+        self._pending  = None
         self.balanceHeats          = ppngen.Weight.MEDIUM
         self.avoidConsecutiveHeats = ppngen.Weight.MEDIUM
         self.avoidConsecutiveLanes = ppngen.Weight.MEDIUM
 
     def __str__(self):
         txt = []
-        txt.append('[RACE]')
+        txt.append(self.SECTION)
         txt.append('uuid = %s'%(self.uuid,))
         txt.append('title = %s'%(self.title,))
         txt.append('lanes = %s'%(self.lanes,))
-        log.notice(str(self.vehicles))
+        txt.append('rounds = %s'%(self.rounds,))
         for uuid in self.vehicles:
             txt.append('vehicle = %s'%(uuid,))
         return '\n'.join(txt)
 
     def __repr__(self):
-        return 'Race uuid=%s title=%s lanes=%s vehicles=%s'%(
-                self.uuid, self.title, self.lanes, self.vehicles)
+        return 'Race uuid=%s title=%s lanes=%s rounds=%s vehicles=%s'%(
+                self.uuid, self.title, self.lanes, self.rounds, self.vehicles)
 
     def addVehicle(self, uuid):
         self.heats = None
@@ -217,6 +499,8 @@ class Race(object):
     def config(self, key, val):
         if key == 'vehicle':
             self.addVehicle(val)
+        elif key == 'drop':
+            self.delVehicle(val)
         else:
             try:
                 self.__setattr__(key, val)
@@ -224,40 +508,82 @@ class Race(object):
                 return False
         return True
 
+    def _fget_pending(self):
+        return self._pending is not None
+    pending = property(fget=_fget_pending)
+
+    # (lanes, cars, rounds, W1, W2, W3, optimize) to generate the heats
+    # for. optimize is the seconds spent improving the order with the
+    # Improve Heat Order setting on, else 0. Without weights there's
+    # nothing to improve.
+    def request(self):
+        W = (self.balanceHeats, self.avoidConsecutiveHeats, self.avoidConsecutiveLanes)
+        optimize = 0
+        if sum(W) and settings.get('optimize') == '1':
+            optimize = Race.OPTIMIZE
+        return (self.lanes, len(self.vehicles), self.rounds) + W + (optimize,)
+
+    # The precomputed heats for common sizes, or None. The atlas only has
+    # the greedy order.
+    def atlasHeats(self):
+        req = self.request()
+        if atlas is None or req[-1]:
+            return None
+        return atlas.lookup(*req[:-1])
+
     def makeHeats(self):
         if not self.heats:
-            ppn = ppngen.Ppn(self.lanes, len(self.vehicles))
-            ppn.W1 = self.balanceHeats
-            ppn.W2 = self.avoidConsecutiveHeats
-            ppn.W3 = self.avoidConsecutiveLanes
-            ppnheats = ppn.generate()
+            heats = self.atlasHeats()
+            if heats is not None:
+                self._pending = iter(heats)
+            else:
+                self._pending = schedules.iterHeats(*self.request())
 
-            vehicles = [cfg.vehicles[uuid] for uuid in self.vehicles]
-            vehicles.sort(key=operator.attrgetter('vin'))
+            self._entrants = [cfg.vehicles[uuid] for uuid in self.vehicles]
+            self._entrants.sort(key=operator.attrgetter('vin'))
 
             self.heats = []
-            for h in range(0, len(ppnheats)):
-                heat = []
-                self.heats.append(heat)
-                for l in range(0, self.lanes):
-                    res = Result()
-                    res.vehicle = vehicles[ppnheats[h][l]-1]
-                    res.position = 0
-                    heat.append(res)
-
-            self.standings = {}
-            for v in vehicles:
-                self.standings[v.uuid] = Standing(v)
+            self.standings = standings.Standings(self._entrants)
+
+            self.moreHeats(1)
+
+    # Take up to n more heats from the schedule as it is being ordered
+    def moreHeats(self, n):
+        added = 0
+        while self._pending is not None and added < n:
+            try:
+                ppnheat = self._pending.next()
+            except StopIteration:
+                self._pending = None
+                log.notice("Schedule cache hits=%d misses=%d",
+                        schedules.hits, schedules.misses)
+                break
+
+            heat = []
+            for l in range(0, self.lanes):
+                res = Result()
+                res.vehicle = self._entrants[ppnheat[l]-1]
+                res.position = 0
+                heat.append(res)
+            self.heats.append(heat)
+            added += 1
+        return added
 
 class Result(object):
     def __init__(self):
         self.vehicle = None
         self.position = None
 
-class Standing(object):
-    def __init__(self, vehicle):
+################################################################################
+##
+##  DuplicateVin
+##
+################################################################################
+class DuplicateVin(Exception):
+    def __init__(self, vin, vehicle):
+        Exception.__init__(self, "Vehicle ID %s is already used by %s"%(vin, vehicle.owner or 'another vehicle'))
+        self.vin = vin
         self.vehicle = vehicle
-        self.points = 0
 
 ################################################################################
 ##
@@ -265,92 +591,524 @@ class Standing(object):
 ##
 ################################################################################
 class Config(object):
-    SECTIONS = ('VEHICLE','RACE')
-
-    def __init__(self, filename):
+    # Events passed to listeners with the object, and for UPDATED the key.
+    # RESET, with no object, is for many changes at once.
+    ADDED   = 'added'
+    REMOVED = 'removed'
+    UPDATED = 'updated'
+    RESET   = 'reset'
+
+    SECTIONS = ('VEHICLE','RACE','DELETE')
+
+    # Seconds the background writer lets changes gather before saving
+    DELAY = 0.5
+
+    # Journal bytes that trigger a new snapshot
+    JOURNAL_MAX = 256 * 1024
+
+    # With a store (a derbydata.Database) each vehicle and race is kept as
+    # its own record keyed by uuid, and the text file at filename is only
+    # imported from when the store is empty. Without one the text file,
+    # with its journal, is the config.
+    def __init__(self, filename, delay=None, store=None, uniqueVins=False):
         self.filename = filename
+        self.store = store
         self.vehicles = {}
         self.races = {}
 
+        # Vehicle uuids by vin and by group, and race uuids by the vehicles
+        # entered in them. With uniqueVins, adding or changing a vehicle to
+        # a vin another vehicle has raises DuplicateVin.
+        self.vins       = {}
+        self.groups     = {}
+        self.entries    = {}
+        self.uniqueVins = uniqueVins
+
+        if delay is None:
+            delay = Config.DELAY
+        self.delay    = delay
+        self.dirty    = False
+        self.lock     = threading.Lock()
+        self.saving   = threading.Lock()
+        self.wake     = threading.Event()
+        self.writer   = None
+        self.queued   = False
+        self.watching = False
+
+        # Changes are appended to the journal and replayed over the last
+        # snapshot, whose stamp the journal carries
+        self.journal     = filename + '.journal'
+        self.journalSize = 0
+        self.stamp       = None
+        self.full        = True
+
+        # What the writer saves next, all of it text made by write(): the
+        # journal records, with a store the record of each changed object by
+        # uuid (None once deleted), and a full snapshot as (uuid, record)
+        # pairs. Both threads change these, so only under lock.
+        self.pending     = []
+        self.pendingSize = 0
+        self.changed     = {}
+        self.snapshot    = None
+
+        # Called as listener(event, obj, key) as objects change
+        self.listeners = []
+
+    def listen(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self, event, obj, key=None):
+        for listener in self.listeners:
+            listener(event, obj, key)
+
     def addObject(self, obj):
-        log.notice('addObject %s'%repr(obj))
         if isinstance(obj, Vehicle):
+            self.checkVin(obj, obj.vin)
+        self.register(obj)
+
+    # Adds many objects with one RESET for the listeners. Vehicles whose
+    # vin is taken are left out, and returned with their DuplicateVin.
+    def addObjects(self, objs):
+        rejected = []
+        for obj in objs:
+            if isinstance(obj, Vehicle):
+                try:
+                    self.checkVin(obj, obj.vin)
+                except DuplicateVin, e:
+                    rejected.append((obj, e))
+                    continue
+            self.register(obj, notify=False)
+        self.notify(Config.RESET, None)
+        return rejected
+
+    # Adds obj without checking it, as when loading
+    def register(self, obj, notify=True):
+        log.debug('addObject %r', obj)
+        if isinstance(obj, Vehicle):
+            obj.cfg = self
             self.vehicles[str(obj.uuid)] = obj
+            self.vins.setdefault(obj.vin, set()).add(obj.uuid)
+            self.groups.setdefault(obj.group, set()).add(obj.uuid)
         elif isinstance(obj, Race):
             self.races[str(obj.uuid)] = obj
+            for uid in obj.vehicles:
+                self.entries.setdefault(uid, set()).add(obj.uuid)
+        if notify:
+            self.notify(Config.ADDED, obj)
 
     def delObject(self, obj):
-        log.notice('delObject %s'%repr(obj))
+        log.debug('delObject %r', obj)
         if str(obj.uuid) in self.vehicles:
+            obj.cfg = None
             del self.vehicles[obj.uuid]
-            for uuid in self.races:
-                race = self.races[str(uuid)]
-                if str(obj.uuid) in race.vehicles:
-                    race.delVehicle(obj.uuid)
+            self.unindex(self.vins, obj.vin, obj.uuid)
+            self.unindex(self.groups, obj.group, obj.uuid)
+            for uid in self.entries.pop(obj.uuid, ()):
+                self.races[uid].delVehicle(obj.uuid)
         if obj.uuid in self.races:
             del self.races[obj.uuid]
+            for uid in obj.vehicles:
+                self.unindex(self.entries, uid, obj.uuid)
+        self.notify(Config.REMOVED, obj)
+
+    # Sets a field and tells the listeners. Every change to an object in
+    # the config goes through here, Vehicle.config included, so the
+    # indexes stay current. check=False skips the vin check, for changes
+    # that are already saved.
+    def update(self, obj, key, val, check=True):
+        if isinstance(obj, Vehicle) and key in Vehicle.INDEXED:
+            if key == 'vin' and check:
+                self.checkVin(obj, val)
+            old = getattr(obj, key)
+            if not obj.set(key, val):
+                return False
+            if key == 'vin':
+                index = self.vins
+            else:
+                index = self.groups
+            self.unindex(index, old, obj.uuid)
+            index.setdefault(val, set()).add(obj.uuid)
+        elif isinstance(obj, Race) and key in ('vehicle', 'drop'):
+            obj.config(key, val)
+            if val in obj.vehicles:
+                self.entries.setdefault(val, set()).add(obj.uuid)
+            else:
+                self.unindex(self.entries, val, obj.uuid)
+        elif isinstance(obj, Vehicle):
+            if not obj.set(key, val):
+                return False
+        elif not obj.config(key, val):
+            return False
+        self.notify(Config.UPDATED, obj, key)
+        return True
+
+    def unindex(self, index, key, uid):
+        uids = index.get(key)
+        if uids is not None:
+            uids.discard(uid)
+            if not uids:
+                del index[key]
+
+    def checkVin(self, vehicle, vin):
+        if not (self.uniqueVins and vin):
+            return
+        for uid in self.vins.get(vin, ()):
+            if uid != vehicle.uuid:
+                raise DuplicateVin(vin, self.vehicles[uid])
+
+    ############################################################################
+    ##  Lookups through the indexes
+    ############################################################################
+    def findVin(self, vin):
+        uids = self.vins.get(vin)
+        if uids:
+            return self.vehicles[iter(uids).next()]
+        return None
+
+    def inGroup(self, group):
+        return [self.vehicles[uid] for uid in self.groups.get(group, ())]
+
+    def racesFor(self, vehicle):
+        return [self.races[uid] for uid in self.entries.get(vehicle.uuid, ())]
+
+    def duplicateVins(self):
+        return dict([(vin, [self.vehicles[uid] for uid in uids])
+                for (vin, uids) in self.vins.iteritems() if vin and len(uids) > 1])
 
     def read(self):
-        log.notice('Config.read()')
+        if self.store is not None:
+            self.readStore()
+        else:
+            self.readText()
+
+    # Loads every record with one pass over the store. Vehicles go first so
+    # the races can find their entries.
+    def readStore(self):
+        start = time.time()
+        records = [val for (key, val) in self.store.iteritems()]
+        if not records:
+            if os.path.exists(self.filename):
+                log.notice('Config.readStore() importing %s', self.filename)
+                self.importText(self.filename)
+            return
+        records.sort(key=lambda val: not val.startswith(Vehicle.SECTION))
+        self.parse('\n'.join(records).splitlines())
+        self.full = False
+
+        log.notice('Config.readStore() %d vehicles, %d races in %.3fs',
+                len(self.vehicles), len(self.races), time.time() - start)
+
+    def readText(self):
         try:
             fh = open(self.filename)
         except IOError, e:
-            log.warn(str(e))
+            log.warn(e)
             return
+        start = time.time()
+        try:
+            marks = self.parse(fh)
+        finally:
+            fh.close()
+
+        # A snapshot without a stamp predates the journal, so the first save
+        # writes a fresh one
+        self.stamp = marks.get('snapshot')
+        self.full = self.stamp is None
+        self.replay()
+
+        log.notice('Config.read() %d vehicles, %d races in %.3fs',
+                len(self.vehicles), len(self.races), time.time() - start)
 
-        re_section = re.compile(r'^\[\s*(.*?)\s*\]$')
-        re_config = re.compile(r'^(\S+)\s*=\s*(.*)$')
+    def replay(self):
+        try:
+            fh = open(self.journal)
+        except IOError:
+            return
+        try:
+            stamp = None
+            mo = re.match(r'^#\s*journal\s+(\S+)', fh.readline())
+            if mo:
+                stamp = mo.group(1)
+            if stamp is None or stamp != self.stamp:
+                # Left over from a compaction that didn't finish
+                log.warn("Ignoring journal for snapshot %s", stamp)
+                self.full = True
+                return
+            self.parse(fh)
+            self.journalSize = fh.tell()
+        finally:
+            fh.close()
 
+    # Applies a snapshot or journal. [VEHICLE] and [RACE] sections for a
+    # uuid that's already known update that object, [DELETE] removes one.
+    # Each section's lines are gathered and applied in one go, so a new
+    # object is built once and registered once. Returns the "# name stamp"
+    # marks found.
+    def parse(self, fh):
+        marks = {}
         section = None
-        lineno = 0
-        item = None
+        fields = []
         for x in fh:
-            lineno += 1
             x = x.strip()
             if not x:
                 continue
 
-            mo = re_section.search(x)
-            if mo:
-                section = mo.group(1).upper()
+            if x[0] == '#':
+                words = x[1:].split()
+                if len(words) == 2:
+                    marks[words[0]] = words[1]
+                continue
+
+            if x[0] == '[' and x[-1] == ']':
+                if section:
+                    self.apply(section, fields)
+                section = x[1:-1].strip().upper()
+                fields = []
                 if section not in Config.SECTIONS:
-                    window.alert("Unknown section [%s]", section)
-                    return
-                log.notice('Found %s'%(section,))
-                if section == 'VEHICLE':
-                    item = Vehicle()
-                elif section == 'RACE':
-                    item = Race()
+                    window.alert("Unknown section [%s]"%section)
+                    return marks
                 continue
 
-            mo = re_config.search(x)
-            if mo:
-                key = mo.group(1).lower()
-                val = mo.group(2)
-                log.notice('Found %s = %s'%(key,val))
-                self.delObject(item)
-                if not item.config(key, val):
+            (key, eq, val) = x.partition('=')
+            if eq:
+                fields.append((key.strip().lower(), val.strip()))
+
+        if section:
+            self.apply(section, fields)
+        return marks
+
+    def apply(self, section, fields):
+        uid = None
+        for (key, val) in fields:
+            if key == 'uuid':
+                uid = val
+                break
+
+        old = self.vehicles.get(uid) or self.races.get(uid)
+        if section == 'DELETE':
+            if old is not None:
+                self.delObject(old)
+            return
+
+        if old is not None:
+            # An update from the journal
+            for (key, val) in fields:
+                if key != 'uuid' and not self.update(old, key, val, check=False):
                     log.error("Unknown key for [%s]: %s", section, key)
-                self.addObject(item)
+            return
+
+        if section == 'VEHICLE':
+            item = Vehicle(uid=uid)
+        else:
+            item = Race(uid=uid)
+        for (key, val) in fields:
+            if key == 'uuid':
                 continue
+            if key == 'vehicle':
+                # Added directly, addVehicle would clear the heats each time
+                if val in self.vehicles:
+                    item.vehicles.add(val)
+            elif not item.config(key, val):
+                log.error("Unknown key for [%s]: %s", section, key)
+        self.register(item)
+
+    ############################################################################
+    ##  Change records, as written to the journal
+    ############################################################################
+    def record(self, obj, key, val):
+        return '%s\nuuid = %s\n%s = %s'%(obj.SECTION, obj.uuid, key, val)
+
+    def deletion(self, obj):
+        return '[DELETE]\nuuid = %s'%(obj.uuid,)
+
+    # Every record's second line is its uuid
+    def recordUuid(self, txt):
+        return txt.split('\n', 2)[1].partition('=')[2].strip()
+
+    # Every object's record, vehicles first so the races can find their
+    # entries when it's read back
+    def serialize(self):
+        return [(obj.uuid, str(obj)) for obj in self.vehicles.values() + self.races.values()]
+
+    # Marks the config changed, with the change records for the journal.
+    # Without any the next save writes a full snapshot. A background thread
+    # saves once the changes stop for delay seconds, so a burst of edits is
+    # one write.
+    #
+    # Everything the writer needs is made into text here, on the thread
+    # that changes the objects, so it never reads them while they change.
+    def write(self, *records):
+        self.lock.acquire()
+        try:
+            if self.store is not None:
+                for txt in records:
+                    uid = self.recordUuid(txt)
+                    obj = self.vehicles.get(uid) or self.races.get(uid)
+                    if obj is None:
+                        self.changed[uid] = None
+                    else:
+                        self.changed[uid] = str(obj)
+            else:
+                self.pending.extend(records)
+                self.pendingSize += sum([len(r) + 2 for r in records])
+            if not records or (self.snapshot is None and (self.full or
+                    (self.store is None and
+                     self.journalSize + self.pendingSize > Config.JOURNAL_MAX))):
+                # The snapshot has every change so far, later ones are
+                # journalled after it
+                self.snapshot = self.serialize()
+                self.full = False
+                self.pending = []
+                self.pendingSize = 0
+                self.changed = {}
+            self.dirty = True
+            self.queued = True
+        finally:
+            self.lock.release()
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.writeBehind, name='Config.writer')
+            self.writer.setDaemon(True)
+            self.writer.start()
+        self.wake.set()
+        if not self.watching:
+            self.watching = True
+            window.setTimeout(self.watch, self.delay * 1000)
+
+    # Polls the log on the page thread until the writer has taken what
+    # write() queued and finished saving it, so what it logs is written out
+    def watch(self):
+        queued = self.queued
+        busy = not self.saving.acquire(False)
+        if not busy:
+            self.saving.release()
+        log.poll()
+        if queued or busy:
+            window.setTimeout(self.watch, self.delay * 1000)
+        else:
+            self.watching = False
+
+    def writeBehind(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.delay)
+            self.wake.clear()
+            self.flush()
+
+    # Saves now if there are unsaved changes. Changes are appended to the
+    # journal until it grows past JOURNAL_MAX bytes, then compacted into a
+    # new snapshot. The lock is only held to take what write() left, the
+    # saving lock keeps a flush from the UI and the writer's apart.
+    def flush(self):
+        self.saving.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                self.queued = False
+                if not self.dirty:
+                    return
+                # Cleared first, so changes made while saving mark it again
+                self.dirty = False
+                (records, self.pending) = (self.pending, [])
+                (changed, self.changed) = (self.changed, {})
+                (snapshot, self.snapshot) = (self.snapshot, None)
+                self.pendingSize = 0
+            finally:
+                self.lock.release()
 
-    def write(self):
-        log.notice('Config.write()')
+            try:
+                if self.store is not None:
+                    self.saveStore(snapshot, changed)
+                else:
+                    if snapshot is not None:
+                        self.save(snapshot)
+                    if records:
+                        self.append(''.join([r + '\n\n' for r in records]))
+            except EnvironmentError, e:
+                log.error("Error writing '%s'\n%s", self.filename, e)
+                # The next write saves everything again
+                self.lock.acquire()
+                try:
+                    self.dirty = True
+                    self.full = True
+                finally:
+                    self.lock.release()
+        finally:
+            self.saving.release()
+
+    def append(self, txt):
+        fh = open(self.journal, 'a')
         try:
-            fh = open(self.filename, 'w')
-        except Exception, e:
-            window.alert("Error writing '%s'\n%s", self.filename, e)
-            return
+            if not self.journalSize:
+                fh.write('# journal %s\n\n'%(self.stamp,))
+            fh.write(txt)
+            fh.flush()
+            os.fsync(fh.fileno())
+            self.journalSize = fh.tell()
+        finally:
+            fh.close()
 
-        for (k,v) in self.vehicles.iteritems():
-            print >>fh, str(v)
-            print >>fh
+    # Writes a full snapshot to a temporary file and renames it over the
+    # config, so a failed save never leaves a truncated file behind. The
+    # journal is stamped with its snapshot, so if the old journal can't be
+    # removed it's ignored rather than replayed over the new snapshot.
+    def save(self, snapshot):
+        log.notice('Config.save()')
+        stamp = '%.6f'%max(time.time(), float(self.stamp or 0) + 0.000001)
+        self.writeText(self.filename, stamp, snapshot)
+        self.stamp = stamp
+        self.journalSize = 0
+        try:
+            os.remove(self.journal)
+        except OSError:
+            pass
 
-        for (k,v) in self.races.iteritems():
-            print >>fh, str(v)
+    def writeText(self, filename, stamp, snapshot):
+        tmp = filename + '.tmp'
+        fh = open(tmp, 'w')
+        try:
+            print >>fh, '# snapshot %s'%stamp
             print >>fh
+            for (uid, txt) in snapshot:
+                print >>fh, txt
+                print >>fh
+            fh.flush()
+            os.fsync(fh.fileno())
+        finally:
+            fh.close()
 
-        fh.close()
+        try:
+            os.rename(tmp, filename)
+        except OSError:
+            # Windows won't rename over an existing file
+            os.remove(filename)
+            os.rename(tmp, filename)
+
+    # Writes the record of each changed object, one store record per object
+    # however many of its fields changed. A snapshot rewrites every record
+    # and drops the ones of deleted objects, before the changes made after
+    # it. Writes and deletes each open the store once.
+    def saveStore(self, snapshot, changed):
+        if snapshot is not None:
+            current = set([uid for (uid, txt) in snapshot])
+            self.store.update(snapshot)
+            self.store.delete([key for key in self.store.keys() if key not in current])
+
+        self.store.update([(uid, txt) for (uid, txt) in changed.iteritems() if txt is not None])
+        self.store.delete([uid for (uid, txt) in changed.iteritems() if txt is None])
+
+    ############################################################################
+    ##  The text format, for moving an event in or out of the store
+    ############################################################################
+    def importText(self, filename):
+        fh = open(filename)
+        try:
+            self.parse(fh)
+        finally:
+            fh.close()
+        self.write()
+
+    def exportText(self, filename):
+        self.writeText(filename, '%.6f'%time.time(), self.serialize())
 
 ################################################################################
 ##
@@ -361,19 +1119,36 @@ class Page(object):
     title = ''
     special = ''
 
+    # The page last rendered, the one being shown
+    current = None
+
     def __init__(self, cfg):
         self.cfg = cfg
 
     def __str__(self):
-        return self.content()
+        return str(self.content())
 
+    # An htmltags tree, or a string of HTML
     def content(self):
         return ''
 
+    # Trees are patched into the page by contentView, which renders in full
+    # when the page changes
     def render(self):
+        Page.current = self
         document.getElementById('hdr-center').innerHTML = self.title
         document.getElementById('hdr-right').innerHTML = self.special
-        document.getElementById('content').innerHTML = self.content()
+        content = self.content()
+        if isinstance(content, TAG):
+            contentView.render(content, key=self)
+        else:
+            contentView.invalidate()
+            document.getElementById('content').innerHTML = content
+        self.rendered()
+
+    # Called once the content is in the page
+    def rendered(self):
+        pass
 
 ################################################################################
 ##
@@ -439,7 +1214,50 @@ class HomePage(Page):
         ht <= tr
 
         root <= ht
-        return str(root)
+
+        p = P()
+        p <= INPUT(type="button", id="import", value="Import Event", onclick="homePage.chooseFile()")
+        p <= INPUT(type="button", id="export", value="Export Event", onclick="homePage.exportEvent()")
+        root <= p
+        return root
+
+    def chooseFile(self):
+        options = {
+            'multiple'         : False,
+            'title'            : "Import Event",
+            'types'            : ['cfg', 'txt'],
+            'files'            : True,
+            'directories'      : False,
+            'typesDescription' : "All files",
+            'defaultName'      : None,
+            'path'             : Titanium.Filesystem.getUserDirectory()
+        }
+        Titanium.UI.openFileChooserDialog(homePage.importEvent, options)
+
+    # Vehicles and races from an exported event are added to this one, or
+    # replace the ones with the same uuid
+    def importEvent(self, filelist):
+        if not filelist:
+            return
+        fname = filelist[0]
+        log.notice("homePage.importEvent() %s", fname)
+        try:
+            self.cfg.importText(fname)
+        except IOError, e:
+            window.alert("Can't read %s\n%s"%(fname, e))
+            return
+        window.alert("Event now has %d vehicles and %d races"%(
+                len(self.cfg.vehicles), len(self.cfg.races)))
+
+    # The whole event in the derby.cfg text format
+    def exportEvent(self):
+        log.notice("homePage.exportEvent() %s", EXPORTFILE)
+        try:
+            self.cfg.exportText(EXPORTFILE)
+        except EnvironmentError, e:
+            window.alert("Can't write to %s\n%s"%(EXPORTFILE, e))
+            return
+        window.alert('Event written to\n%s'%EXPORTFILE)
 
 ################################################################################
 ##
@@ -449,12 +1267,15 @@ class HomePage(Page):
 class ManageVehicles(Page):
     title = "Manage Vehicles"
 
+    # Milliseconds between checks on a running import
+    POLL = 100
+
     def __init__(self, cfg):
         super(ManageVehicles, self).__init__(cfg)
+        self.importer = None
 
     def content(self):
         root = DIV(id='root')
-        tbl = TABLE()
         tr = TR()
 
         hdr = 'Vehicle ID'
@@ -478,42 +1299,71 @@ class ManageVehicles(Page):
             hdr += ' ' + tri_dsc
         tr <= TH() <= A(href="javascript:manageVehiclesSort.toggle_grp()") <= hdr
 
-        tbl <= tr
-        root <= tbl
-
-        for v in manageVehiclesSort.sorted:
-            tr = TR()
-            tr <= TD() <= INPUT(type="text", id="vin+%s"%v.uuid, value="%s"%v.vin, onchange="manageVehicles.update(this)")
-            tr <= TD() <= INPUT(type="text", id="owner+%s"%v.uuid, value="%s"%v.owner, onchange="manageVehicles.update(this)")
-            tr <= TD() <= INPUT(type="text", id="group+%s"%v.uuid, value="%s"%v.group, onchange="manageVehicles.update(this)")
-            tr <= TD() <= INPUT(type="button", id="del+%s"%v.uuid, value="Delete", onclick="manageVehicles.remove(this)")
-            tbl <= tr
+        root <= manageVehiclesWindow.table(tr, self.vehicleRow, 4)
 
         p = P()
         p <= INPUT(type="button", id="add", value="Add Vehicle", onclick="manageVehicles.add(this)")
         p <= INPUT(type="button", id="import", value="Import CSV File", onclick="manageVehicles.chooseFile()")
+        p <= INPUT(type="checkbox", id="unique", CHECKED=self.cfg.uniqueVins, onchange="manageVehicles.setUniqueVins(this)")
+        p <= "Unique Vehicle IDs"
         root <= p
 
-        return str(root)
+        return root
+
+    def vehicleRow(self, v):
+        tr = TR(id="veh+%s"%v.uuid)
+        tr <= TD() <= INPUT(type="text", id="vin+%s"%v.uuid, value="%s"%v.vin, onchange="manageVehicles.update(this)")
+        tr <= TD() <= INPUT(type="text", id="owner+%s"%v.uuid, value="%s"%v.owner, onchange="manageVehicles.update(this)")
+        tr <= TD() <= INPUT(type="text", id="group+%s"%v.uuid, value="%s"%v.group, onchange="manageVehicles.update(this)")
+        tr <= TD() <= INPUT(type="button", id="del+%s"%v.uuid, value="Delete", onclick="manageVehicles.remove(this)")
+        return tr
+
+    def rendered(self):
+        manageVehiclesWindow.restore()
 
     def add(self, this):
         v = Vehicle()
         self.cfg.addObject(v)
-        self.cfg.write()
+        self.cfg.write(str(v))
         self.render()
 
     def update(self, this):
         (col, uuid) = this.id.split('+')
         val = this.value.strip()
-        log.notice("update %s %s %s"%(uuid,col,val))
-        self.cfg.vehicles[uuid].config(col, val)
-        self.cfg.write()
+        log.debug("update %s %s %s", uuid, col, val)
+        v = self.cfg.vehicles[uuid]
+        try:
+            self.cfg.update(v, col, val)
+        except DuplicateVin, e:
+            window.alert(str(e))
+            this.value = getattr(v, col)
+            return
+        self.cfg.write(self.cfg.record(v, col, val))
+
+    # Vehicle IDs can only be made unique once no two vehicles share one
+    def setUniqueVins(self, this):
+        if this.checked:
+            dups = sorted(self.cfg.duplicateVins().keys())
+            if dups:
+                more = ''
+                if len(dups) > 10:
+                    more = '\n... and %d more'%(len(dups) - 10)
+                window.alert("These vehicle IDs are used more than once:\n\n%s%s"%(
+                        '\n'.join(dups[:10]), more))
+                this.checked = False
+                return
+        self.cfg.uniqueVins = bool(this.checked)
+        settings['uniqueVins'] = str(int(self.cfg.uniqueVins))
 
     def remove(self, this):
         (col, uuid) = this.id.split('+')
-        log.notice("remove %s vin=%s"%(uuid,self.cfg.vehicles[uuid].vin))
-        self.cfg.delObject(self.cfg.vehicles[uuid])
-        self.cfg.write()
+        v = self.cfg.vehicles[uuid]
+        log.notice("remove %s vin=%s", uuid, v.vin)
+        # Deleting the vehicle drops it from its races, whose records
+        # change too
+        drops = [self.cfg.record(race, 'drop', v.uuid) for race in self.cfg.racesFor(v)]
+        self.cfg.delObject(v)
+        self.cfg.write(*(drops + [self.cfg.deletion(v)]))
         self.render()
 
     def chooseFile(self):
@@ -529,29 +1379,49 @@ class ManageVehicles(Page):
         }
         Titanium.UI.openFileChooserDialog(manageVehicles.importCsv, options)
 
+    # The files are read by a csvimport.Importer thread while poll shows
+    # its progress. The vehicles are added together once it's done, with
+    # one write and one report of the rows that were skipped. The import
+    # carries on if another page is shown, which is left as it is.
     def importCsv(self, filelist):
-        for f in filelist:
-            log.notice(f)
-            try:
-                reader = csv.reader(open(f, "rb"))
-            except Exception, e:
-                window.alert("Can't read %s:\n%s"%(f,e))
-                continue
-
-            i = 0
-            for row in reader:
-                i += 1
-                if len(row) != 3:
-                    window.alert("Parse error at %s:%d\nMust have VechicleID, Owner, and Group"%(f,i))
-                    continue
-                v = Vehicle()
-                v.vin   = row[0].strip()
-                v.owner = row[1].strip()
-                v.group = row[2].strip()
-                self.cfg.addObject(v)
-
-        self.cfg.write()
-        self.render()
+        if self.importer is not None:
+            window.alert("An import is already running")
+            return
+        log.notice('importCsv %s', filelist)
+        known = None
+        if self.cfg.uniqueVins:
+            known = self.cfg.vins.keys()
+        self.importer = csvimport.Importer(filelist, known)
+        self.importer.start()
+        window.setTimeout(self.poll, self.POLL)
+
+    def poll(self):
+        log.poll()
+        importer = self.importer
+        if not importer.done:
+            if Page.current is self:
+                (count, read, size) = importer.progress()
+                pct = ''
+                if size:
+                    pct = ' (%d%%)'%(100 * read / size)
+                document.getElementById('hdr-right').innerHTML = "Importing %d vehicles%s"%(count, pct)
+            window.setTimeout(self.poll, self.POLL)
+            return
+        self.importer = None
+
+        vehicles = [Vehicle(vin, owner, group, uid) for (uid, vin, owner, group) in importer.rows]
+        for (v, e) in self.cfg.addObjects(vehicles):
+            importer.errors.append(('', 0, str(e)))
+        added = [str(v) for v in vehicles if v.uuid in self.cfg.vehicles]
+        if added:
+            self.cfg.write(*added)
+        log.notice('importCsv %d vehicles, %d errors in %.2fs',
+                len(added), len(importer.errors), importer.elapsed)
+
+        if Page.current is self:
+            self.render()
+        if importer.errors:
+            window.alert("Imported %d vehicles\n\n%s"%(len(added), importer.report()))
 
 ################################################################################
 ##
@@ -561,12 +1431,21 @@ class ManageVehicles(Page):
 class ManageRaces(Page):
     title = "Manage Races"
 
+    # Milliseconds between checks on a running search or batch
+    POLL = 100
+
+    def __init__(self, cfg):
+        super(ManageRaces, self).__init__(cfg)
+        self.search = None
+        self.batch  = None
+
     def content(self):
         root = DIV(id='root')
         tbl = TABLE()
         tr = TR()
         tr <= TH(Class='label') <= 'Race Title'
         tr <= TH() <= 'Lanes'
+        tr <= TH() <= 'Rounds'
         tr <= TH() <= 'Vehicles'
         tr <= TH()
         tr <= TH()
@@ -575,10 +1454,10 @@ class ManageRaces(Page):
 
         races = sorted(self.cfg.races.values(), key=operator.attrgetter('title'))
         for r in races:
-            log.notice(str(r.uuid))
-            tr = TR()
+            tr = TR(id="race+%s"%r.uuid)
             tr <= TD() <= r.title
             tr <= TD(Class='center') <= str(r.lanes)
+            tr <= TD(Class='center') <= str(r.rounds)
             tr <= TD(Class='center') <= str(len(r.vehicles))
             tr <= TD(Class='center') <= INPUT(type="button", id="edt+%s"%r.uuid, value="Edit",   onclick="manageRaces.edit(this)")
             tr <= TD(Class='center') <= INPUT(type="button", id="del+%s"%r.uuid, value="Delete", onclick="manageRaces.remove(this)")
@@ -587,45 +1466,124 @@ class ManageRaces(Page):
 
         p = P()
         p <= INPUT(type="button", id="add", value="Add Race", onclick="manageRaces.add(this)")
+        p <= INPUT(type="checkbox", id="optimize", CHECKED=settings.get('optimize') == '1', onchange="manageRaces.setOptimize(this)")
+        p <= "Improve Heat Order"
         root <= p
 
-        return str(root)
+        return root
+
+    # Races whose heats are made from now on get them in the improved order
+    def setOptimize(self, this):
+        settings['optimize'] = str(int(bool(this.checked)))
 
     def add(self, this):
         log.notice('ManageRaces.add()')
         race = Race()
         self.cfg.addObject(race)
-        self.cfg.write()
+        self.cfg.write(str(race))
         editRace.race = race
         editRace.render()
 
     def remove(self, this):
         (col, uuid) = this.id.split('+')
         race = self.cfg.races[uuid]
-        log.notice('ManageRaces.remove() uuid=%s title=%s'%(uuid,race.title))
+        log.notice('ManageRaces.remove() uuid=%s title=%s', uuid, race.title)
         self.cfg.delObject(race)
-        self.cfg.write()
+        self.cfg.write(self.cfg.deletion(race))
         self.render()
 
     def edit(self, this):
         (col, uuid) = this.id.split('+')
         race = self.cfg.races[uuid]
-        log.notice('ManageRaces.edit() uuid=%s title=%s'%(uuid,race.title))
+        log.notice('ManageRaces.edit() uuid=%s title=%s', uuid, race.title)
         editRace.race = race
         editRace.render()
 
     def run(self, this):
         (col, uuid) = this.id.split('+')
         race = self.cfg.races[uuid]
-        log.notice('ManageRaces.run() uuid=%s title=%s'%(uuid,race.title))
+        log.notice('ManageRaces.run() uuid=%s title=%s', uuid, race.title)
+        if self.search is not None:
+            window.alert("Still finding the heats for %s"%self.search[0].title)
+            return
         if len(race.vehicles) < 2:
             window.alert("Need at least two vehicles to race.")
             return
         if len(race.vehicles) < race.lanes:
             race.lanes = len(race.vehicles)
+            self.cfg.write(self.cfg.record(race, 'lanes', race.lanes))
+        self.cfg.flush()
+        self.prepare(race)
+        self.start(race)
+
+    # Sizes past the tables need their generators searched for, which can
+    # take seconds, so a ppnsearch.Search thread does that while poll
+    # waits for it. The generators found are kept, so it's only once.
+    def start(self, race):
+        (nLanes, nCars, nRounds) = race.request()[:3]
+        if ppngen.distinctRounds(nLanes, nCars) is None and ppnsearch.known(nLanes, nCars, nRounds) is None:
+            log.notice('ManageRaces.start() searching %d lanes %d cars %d rounds', nLanes, nCars, nRounds)
+            self.search = (race, ppnsearch.Search(nLanes, nCars, nRounds))
+            self.search[1].start()
+            document.getElementById('hdr-right').innerHTML = "Finding heats for %d vehicles"%nCars
+            window.setTimeout(self.poll, self.POLL)
+            return
         runRace.race = race
         runRace.render()
 
+    def poll(self):
+        log.poll()
+        (race, search) = self.search
+        if not search.done:
+            window.setTimeout(self.poll, self.POLL)
+            return
+        self.search = None
+        if Page.current is not self:
+            # Left for another page, the race runs when it's run again
+            return
+        document.getElementById('hdr-right').innerHTML = self.special
+
+        if search.parms is None:
+            window.alert("Couldn't find heats for %d vehicles on %d lanes."%(len(race.vehicles), race.lanes))
+            return
+        # Fewer rounds than asked for are repeated to make up the rest, as
+        # for sizes in the tables. Kept as the answer for the race's rounds
+        # so it isn't searched again.
+        (nLanes, nCars, nRounds) = search.args
+        found = len(search.parms[0])
+        if found < nRounds:
+            log.notice('ManageRaces.poll() %d of %d rounds found, repeating them', found, nRounds)
+            ppnsearch.keep(nLanes, nCars, nRounds, search.parms)
+        self.start(race)
+
+    # Generate the schedules of the other races in one batch on a thread,
+    # so each one is ready when it is run. The race being run streams its
+    # own heats meanwhile.
+    def prepare(self, running=None):
+        if self.batch is not None:
+            return
+        requests = []
+        for race in self.cfg.races.values():
+            if race is running or race.heats or len(race.vehicles) < 2:
+                continue
+            if race.atlasHeats() is None:
+                requests.append(race.request())
+        if requests:
+            self.batch = schedules.startMany(requests)
+        if self.batch is not None:
+            log.notice('ManageRaces.prepare() %d schedules', len(self.batch.todo))
+            window.setTimeout(self.pollBatch, self.POLL)
+
+    def pollBatch(self):
+        log.poll()
+        batch = self.batch
+        if not batch.done:
+            window.setTimeout(self.pollBatch, self.POLL)
+            return
+        self.batch = None
+        schedules.finishMany(batch)
+        log.notice('ManageRaces.prepare() %d schedules in %.2fs', len(batch.todo), batch.elapsed)
+
 ################################################################################
 ##
 ##  EditRace
@@ -645,9 +1603,14 @@ class EditRace(Page):
             flag = (i == self.race.lanes)
             sel <= OPTION(value="%s"%i, SELECTED=flag) <= "%s"%i
         p <= sel
+        p <= "Rounds: "
+        sel = SELECT(id='roundsel', onchange="editRace.update_rounds(this)")
+        for i in range(1,5):
+            flag = (i == self.race.rounds)
+            sel <= OPTION(value="%s"%i, SELECTED=flag) <= "%s"%i
+        p <= sel
         root <= p
 
-        tbl = TABLE()
         tr = TR()
 
         hdr = 'Vehicle ID'
@@ -671,41 +1634,50 @@ class EditRace(Page):
             hdr += ' ' + tri_dsc
         tr <= TH() <= A(href="javascript:editRaceSort.toggle_grp()") <= hdr
 
-        tbl <= tr
-        root <= tbl
+        root <= editRaceWindow.table(tr, self.entrantRow, 4)
 
-        for v in editRaceSort.sorted:
-            flag = v.uuid in self.race.vehicles
-            tr = TR()
-            tr <= TD() <= v.vin
-            tr <= TD() <= v.owner
-            tr <= TD() <= v.group
-            tr <= TD() <= INPUT(type="checkbox", id="uuid+%s"%v.uuid, CHECKED=flag, onchange="editRace.check(this)")
-            tbl <= tr
+        return root
 
-        return str(root)
+    def entrantRow(self, v):
+        flag = v.uuid in self.race.vehicles
+        tr = TR(id="ent+%s"%v.uuid)
+        tr <= TD() <= v.vin
+        tr <= TD() <= v.owner
+        tr <= TD() <= v.group
+        tr <= TD() <= INPUT(type="checkbox", id="uuid+%s"%v.uuid, CHECKED=flag, onchange="editRace.check(this)")
+        return tr
+
+    def rendered(self):
+        editRaceWindow.restore()
 
     def update_title(self, this):
-        log.notice('update_title')
+        log.debug('update_title')
         val = this.value.strip()
         self.race.title = val
-        self.cfg.write()
+        self.cfg.write(self.cfg.record(self.race, 'title', val))
 
     def update_lanes(self, this):
-        log.notice('update_lanes')
+        log.debug('update_lanes')
         val = int(this.value)
         self.race.lanes = val
-        self.cfg.write()
+        self.cfg.write(self.cfg.record(self.race, 'lanes', val))
+
+    def update_rounds(self, this):
+        log.debug('update_rounds')
+        val = int(this.value)
+        self.race.rounds = val
+        self.cfg.write(self.cfg.record(self.race, 'rounds', val))
 
     def check(self, this):
-        log.notice('check')
+        log.debug('check')
         val = bool(this.value)
         (col, uuid) = this.id.split('+')
         if val:
-            self.race.addVehicle(uuid)
+            self.cfg.update(self.race, 'vehicle', uuid)
+            self.cfg.write(self.cfg.record(self.race, 'vehicle', uuid))
         else:
-            self.race.delVehicle(uuid)
-        self.cfg.write()
+            self.cfg.update(self.race, 'drop', uuid)
+            self.cfg.write(self.cfg.record(self.race, 'drop', uuid))
 
 ################################################################################
 ##
@@ -716,6 +1688,9 @@ class RunRace(Page):
     title = "Run The Race"
     special = ''
 
+    # Heats added to the table per step while the schedule streams in
+    CHUNK = 10
+
     def _fget_race(self):
         return self._race
     def _fset_race(self, race):
@@ -739,48 +1714,70 @@ class RunRace(Page):
         tbl = TABLE(id="heats")
         tr = TR()
         tr <= TH() <= 'Heat'
+        if self.race.rounds > 1:
+            tr <= TH() <= 'Round'
         for l in range(0, nLanes):
             tr <= TH() <= 'Lane %d'%(l+1)
         tbl <= tr
 
         for h in range(0, nHeats):
             tr = TR(id="heat%03d"%h)
-            tr <= TD() <= "%d"%(h+1)
-            for l in range(0, nLanes):
-                res = self.race.heats[h][l]
-                v = res.vehicle
-                if 0 < res.position <= nLanes:
-                    pos = str(res.position)
-                else:
-                    pos = ''
-                td = TD()
-                td <= v.vin
-                td <= INPUT(id="%03d+%03d+%s"%(h,l,v.uuid), type="text",
-                        value=pos, size="1", maxlength="1",
-                        onblur="runRace.blur(this)",
-                        onfocus="runRace.focus(this)",
-                        onchange="runRace.update(this)")
+            for td in self.heatCells(h):
                 tr <= td
             tbl <= tr
 
         heatdiv <= tbl
         standiv <= self.standingsTable()
 
-        return str(root)
+        if self.race.pending:
+            window.setTimeout(self.more, 0)
 
-    def standingsTable(self):
-        for std in self.race.standings.values():
-            std.points = 0
+        return root
 
-        nHeats = len(self.race.heats)
+    def heatCells(self, h):
         nLanes = self.race.lanes
-        for h in range(0, nHeats):
-            for l in range(0, nLanes):
-                heat = self.race.heats[h][l]
-                if heat.position > 0:
-                    std = self.race.standings[heat.vehicle.uuid]
-                    std.points += 1 + nLanes - heat.position
+        cells = [TD() <= "%d"%(h+1)]
+        if self.race.rounds > 1:
+            nCars = len(self.race.standings)
+            cells.append(TD() <= "%d"%((h / nCars) + 1))
+        for l in range(0, nLanes):
+            res = self.race.heats[h][l]
+            v = res.vehicle
+            if 0 < res.position <= nLanes:
+                pos = str(res.position)
+            else:
+                pos = ''
+            td = TD()
+            td <= v.vin
+            td <= INPUT(id="%03d+%03d+%s"%(h,l,v.uuid), type="text",
+                    value=pos, size="1", maxlength="1",
+                    onblur="runRace.blur(this)",
+                    onfocus="runRace.focus(this)",
+                    onchange="runRace.update(this)")
+            cells.append(td)
+        return cells
+
+    # Append heats to the table while the rest are still being ordered
+    def more(self):
+        tbl = document.getElementById('heats')
+        if tbl is None:
+            # Page was left; the remaining heats come with the next render
+            return
+
+        first = len(self.race.heats)
+        self.race.moreHeats(self.CHUNK)
+        for h in range(first, len(self.race.heats)):
+            row = tbl.insertRow(-1)
+            row.id = "heat%03d"%h
+            row.innerHTML = ''.join([str(td) for td in self.heatCells(h)])
+        contentView.invalidate()
 
+        if self.race.pending:
+            window.setTimeout(self.more, 0)
+
+    # Race.standings keeps the points as positions are entered, so the
+    # table only renders it
+    def standingsTable(self):
         tbl = TABLE()
         tr = TR(id="standings")
         tr <= TH(Class="center") <= 'Points'
@@ -788,19 +1785,25 @@ class RunRace(Page):
         tr <= TH(Class="left") <= 'Owner'
         tbl <= tr
 
-        standings = self.race.standings.values()
-        standings.sort(key=operator.attrgetter('points'), reverse=True)
-        for s in standings:
-            tr = TR()
-            tr <= TD(Class="center") <= str(s.points)
-            tr <= TD(Class="center") <= s.vehicle.vin
-            tr <= TD(Class="left") <= s.vehicle.owner
+        for (rank, points, v) in self.race.standings.rows():
+            tr = TR(id="std%03d"%rank)
+            for td in self.standingCells(points, v):
+                tr <= td
             tbl <= tr
 
-        return str(tbl)
+        return tbl
+
+    def standingCells(self, points, v):
+        return [TD(Class="center") <= str(points),
+                TD(Class="center") <= v.vin,
+                TD(Class="left") <= v.owner]
+
+    def points(self, pos):
+        if pos > 0:
+            return 1 + self.race.lanes - pos
+        return 0
 
     def focus(self, this):
-        log.notice("runRace.focus() %s"%this.id)
         (h,l,uuid) = this.id.split('+')
         h = int(h)
         l = int(l)
@@ -811,7 +1814,6 @@ class RunRace(Page):
         row.style.backgroundColor = "#1A417E"
 
     def blur(self, this):
-        log.notice("runRace.blur() %s"%this.id)
         (h,l,uuid) = this.id.split('+')
         h = int(h)
         l = int(l)
@@ -822,7 +1824,7 @@ class RunRace(Page):
         row.style.backgroundColor = "transparent"
 
     def update(self, this):
-        log.notice("runRace.update() %s"%this.id)
+        log.debug("runRace.update() %s", this.id)
         (h,l,uuid) = this.id.split('+')
         h = int(h)
         l = int(l)
@@ -833,9 +1835,16 @@ class RunRace(Page):
         if not (1 <= pos <= self.race.lanes):
             pos = 0
             this.value = ''
-        self.race.heats[h][l].position = pos
+        res = self.race.heats[h][l]
+        delta = self.points(pos) - self.points(res.position)
+        res.position = pos
 
-        document.getElementById('standiv').innerHTML = self.standingsTable()
+        # Only the rows between the car's old and new rank change
+        for (rank, points, v) in self.race.standings.score(res.vehicle, delta):
+            row = document.getElementById("std%03d"%rank)
+            if row is not None:
+                row.innerHTML = ''.join([str(td) for td in self.standingCells(points, v)])
+        contentView.invalidate()
 
     def clear(self, this):
         self.race.heats = None
@@ -859,7 +1868,7 @@ class RunRace(Page):
 
     def write(self, filelist):
         fname = filelist[0]
-        log.notice("runRace.write() %s"%fname)
+        log.notice("runRace.write() %s", fname)
         try:
             fh = open(fname,'w')
         except IOError, e:
@@ -867,10 +1876,8 @@ class RunRace(Page):
             return
 
         fh.write("Race Results: %s\n\n"%(self.race.title))
-        standings = self.race.standings.values()
-        standings.sort(key=operator.attrgetter('points'), reverse=True)
-        for std in standings:
-            fh.write("%d\t%s\t%s\n"%(std.points, std.vehicle.vin, std.vehicle.owner))
+        for (rank, points, v) in self.race.standings.rows():
+            fh.write("%d\t%s\t%s\n"%(points, v.vin, v.owner))
         fh.close()
 
 ################################################################################
@@ -878,10 +1885,40 @@ class RunRace(Page):
 ##  DerbyRunner
 ##
 ################################################################################
-log = Logger()
-cfg = Config(CFGFILE)
+log = Logger(os.environ.get('DERBY_LOGLEVEL') or 'NOTICE')
+try:
+    atlas = ppnatlas.PpnAtlas.load(ATLASFILE)
+except (EnvironmentError, ValueError, ppngen.PpnException), e:
+    log.warn("No schedule atlas: %s", e)
+    atlas = None
+schedules = ppncache.ScheduleCache(HEATFILE)
+ppnsearch.STORE = derbydata.Database(GENSFILE)
+
+# This interpreter is embedded in the app, so a pool of worker processes
+# would start copies of the app itself. Searches, batches and heat
+# optimizing run in this process. Race.request() optimizes with a single
+# restart, the restarts across processes are for ppngen used on its own.
+ppnsearch.PROCESSES = 1
+ppncache.PROCESSES = 1
+ppnopt.PROCESSES = 1
+settings = derbydata.Database(SETTINGSFILE)
+
+# The event is kept in event.db, one record per object. DERBY_BACKEND=text
+# keeps it in derby.cfg and its journal instead. The store only imports
+# derby.cfg while it's empty, so an event is moved between them with
+# Export Event and Import Event.
+backend = (os.environ.get('DERBY_BACKEND') or 'store').lower()
+if backend not in ('store', 'text'):
+    log.warn("Unknown DERBY_BACKEND %s, using store", backend)
+    backend = 'store'
+store = None
+if backend == 'store':
+    store = derbydata.Database(EVENTFILE)
+cfg = Config(CFGFILE, store=store, uniqueVins=settings.get('uniqueVins') == '1')
 cfg.read()
+Titanium.API.addEventListener(Titanium.EXIT, lambda event: (cfg.flush(), log.flush()))
 
+contentView     = htmlpatch.Patcher(document, 'content', log=log.error)
 helpPage        = HelpPage(cfg)
 homePage        = HomePage(cfg)
 manageVehicles  = ManageVehicles(cfg)
@@ -891,3 +1928,5 @@ editRace        = EditRace(cfg)
 
 manageVehiclesSort = VehicleSort(cfg, manageVehicles.render)
 editRaceSort       = VehicleSort(cfg, editRace.render)
+manageVehiclesWindow = VehicleWindow('manageVehiclesWindow', manageVehiclesSort, manageVehicles)
+editRaceWindow       = VehicleWindow('editRaceWindow', editRaceSort, editRace)
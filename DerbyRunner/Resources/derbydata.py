@@ -26,14 +26,17 @@ class Database(UserDict.DictMixin):
         self._dbm = anydbm.open(self.filename, 'c')
 
     def _close(self):
-        if self._dbm:
+        # An empty dbm is false, so test for None
+        if self._dbm is not None:
             self._dbm.close()
+            self._dbm = None
 
     def __getitem__(self, key):
         self._open()
-        val = self._dbm[str(key)]
-        self._close()
-        return val
+        try:
+            return self._dbm[str(key)]
+        finally:
+            self._close()
 
     def __setitem__(self, key, val):
         self._open()
@@ -42,8 +45,10 @@ class Database(UserDict.DictMixin):
 
     def __delitem__(self, key):
         self._open()
-        del self._dbm[str(key)]
-        self._close()
+        try:
+            del self._dbm[str(key)]
+        finally:
+            self._close()
 
     def keys(self):
         self._open()
@@ -51,6 +56,45 @@ class Database(UserDict.DictMixin):
         self._close()
         return keys
 
+    # Reads every record with the store opened once, rather than once per
+    # key as DictMixin would
+    def iteritems(self):
+        self._open()
+        try:
+            items = [(key, self._dbm[key]) for key in self._dbm.keys()]
+        finally:
+            self._close()
+        return iter(items)
+
+    # Writes many records with the store opened once
+    def update(self, items=(), **kwargs):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        self._open()
+        try:
+            for (key, val) in items:
+                self._dbm[str(key)] = str(val)
+            for (key, val) in kwargs.iteritems():
+                self._dbm[str(key)] = str(val)
+        finally:
+            self._close()
+
+    # Deletes many records with the store opened once. Keys that aren't
+    # there are skipped.
+    def delete(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        self._open()
+        try:
+            for key in keys:
+                try:
+                    del self._dbm[str(key)]
+                except KeyError:
+                    pass
+        finally:
+            self._close()
+
 ################################################################################
 ##
 ##  TC_Database
@@ -148,6 +192,44 @@ class TC_Database(unittest.TestCase):
         self.assertEqual(want_k,got_k)
         self.assertEqual(want_v,got_v)
 
+    def test_open_once(self):
+        opened = []
+        class Counted(Database):
+            def _open(self):
+                opened.append(1)
+                Database._open(self)
+        db = Counted(self.filename)
+        del opened[:]
+        db.update({'abcd' : '12345', 'efgh' : 54321})
+        db.update([('ijkl', '13579')], mnop='24680')
+        self.assertEqual(len(opened), 2)
+        self.assertEqual(dict(db.iteritems()),
+                {'abcd' : '12345', 'efgh' : '54321', 'ijkl' : '13579', 'mnop' : '24680'})
+        self.assertEqual(len(opened), 3)
+
+    def test_delete(self):
+        opened = []
+        class Counted(Database):
+            def _open(self):
+                opened.append(1)
+                Database._open(self)
+        db = Counted(self.filename)
+        db.update({'abcd' : '12345', 'efgh' : '54321', 'ijkl' : '13579'})
+        del opened[:]
+        db.delete(['abcd', 'ijkl', 'none'])
+        db.delete([])
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(dict(db.iteritems()), {'efgh' : '54321'})
+
+    def test_closed(self):
+        db = Database(self.filename)
+        self.assertEqual(list(db.iteritems()), [])
+        self.assertEqual(db._dbm, None)
+        self.assertRaises(KeyError, db.__getitem__, 'none')
+        self.assertEqual(db._dbm, None)
+        self.assertRaises(KeyError, db.__delitem__, 'none')
+        self.assertEqual(db._dbm, None)
+
 ##############################################################################
 ##
 ##  main
@@ -0,0 +1,461 @@
+#! /usr/bin/env python
+################################################################################
+##
+##  htmlpatch.py
+##
+##  Renders htmltags trees into an element by patching what changed since
+##  the last render rather than replacing its innerHTML. The tree is first
+##  flattened to the elements and text the browser will build from it (TR
+##  directly in a TABLE gets the TBODY the parser adds, + siblings become
+##  plain siblings) and then compared with the last one. Elements are
+##  matched by position, or by id where rows come and go. Attributes are
+##  set one by one, and an element whose text changed has only its own
+##  innerHTML replaced. Anything the DOM doesn't agree with falls back to
+##  a full render.
+##
+################################################################################
+import HTMLParser
+import sys
+import unittest
+import htmltags
+
+################################################################################
+##
+##  Node
+##  An element of the flattened tree. Text is kept as plain strings.
+##
+################################################################################
+class Node(object):
+    __slots__ = ('tag', 'attrs', 'kids', 'id')
+
+    def __init__(self, tag, attrs, kids):
+        self.tag   = tag
+        self.attrs = attrs
+        self.kids  = kids
+        self.id    = attrs.get('id')
+
+    def __str__(self):
+        txt = ['<', self.tag.lower()]
+        for (k, v) in self.attrs.iteritems():
+            if v is True:
+                txt.append(' %s'%k)
+            else:
+                txt.append(' %s="%s"'%(k, v))
+        txt.append('>')
+        txt.append(inner(self.kids))
+        if self.tag in htmltags.CLOSING_TAGS:
+            txt.append('</%s>'%self.tag.lower())
+        return ''.join(txt)
+
+def inner(kids):
+    return ''.join([str(kid) for kid in kids])
+
+################################################################################
+##
+##  flatten
+##  The Nodes and strings item turns into, siblings included.
+##
+################################################################################
+def flatten(item):
+    if isinstance(item, basestring):
+        return item and [item] or []
+    if not isinstance(item, htmltags.TAG):
+        return [str(item)]
+
+    out = []
+    if item.tag == 'TEXT':
+        out.extend(flatten(item.inner_HTML))
+    else:
+        kids = flatten(item.inner_HTML)
+        for child in item.children:
+            kids.extend(flatten(child))
+        if item.tag == 'TABLE':
+            kids = tbody(kids)
+        attrs = {}
+        for (k, v) in item.attrs.iteritems():
+            if v is not False:
+                attrs[k.replace('_', '-')] = v
+        out.append(Node(item.tag, attrs, kids))
+    for brother in getattr(item, 'brothers', ()):
+        out.extend(flatten(brother))
+
+    # Adjacent text is one text node
+    merged = []
+    for kid in out:
+        if isinstance(kid, basestring) and merged and isinstance(merged[-1], basestring):
+            merged[-1] += kid
+        else:
+            merged.append(kid)
+    return merged
+
+# Rows directly in a TABLE go in a TBODY, as the parser puts them
+def tbody(kids):
+    out = []
+    body = None
+    for kid in kids:
+        if isinstance(kid, Node) and kid.tag == 'TR':
+            if body is None:
+                body = Node('TBODY', {}, [])
+                out.append(body)
+            body.kids.append(kid)
+        elif isinstance(kid, basestring) and not kid.strip():
+            continue
+        else:
+            body = None
+            out.append(kid)
+    return out
+
+class Mismatch(Exception):
+    pass
+
+# What a DOM that isn't what was last rendered gives: a child that's not
+# there is None, or out of range
+DOM_ERRORS = (Mismatch, AttributeError, IndexError)
+
+def stderr(msg):
+    print >>sys.stderr, msg
+
+################################################################################
+##
+##  Patcher
+##
+##  Keeps what was last rendered into the element with id elementId.
+##  render(tree, key) patches the element when key is the same as last
+##  time, and renders it in full when it isn't, when nothing was rendered,
+##  or when patching fails. Code that changes the element's DOM itself
+##  calls invalidate(), so the next render is a full one. Any other error
+##  while patching is passed to log before the full render.
+##
+################################################################################
+class Patcher(object):
+    def __init__(self, document, elementId, log=stderr):
+        self.document  = document
+        self.elementId = elementId
+        self.log       = log
+        self.last      = None
+        self.key       = None
+
+        # DOM calls made by the last render, and full renders so far
+        self.ops       = 0
+        self.fallbacks = 0
+
+    def invalidate(self):
+        self.last = None
+
+    def render(self, tree, key=None):
+        kids = flatten(tree)
+        el = self.document.getElementById(self.elementId)
+        self.ops = 0
+        try:
+            if self.last is None or key != self.key:
+                raise Mismatch("nothing to patch")
+            self.patchKids(el, self.last, kids)
+        except Exception, e:
+            if not isinstance(e, DOM_ERRORS):
+                self.log("Patcher.render() %s: %s"%(e.__class__.__name__, e))
+            if self.last is not None and key == self.key:
+                self.fallbacks += 1
+            self.ops = 1
+            el.innerHTML = inner(kids)
+        self.last = kids
+        self.key  = key
+
+    def patch(self, el, old, new):
+        if old.tag != new.tag:
+            self.ops += 1
+            el.outerHTML = str(new)
+            return
+        if str(el.tagName).upper() != old.tag:
+            raise Mismatch("%s where %s was rendered"%(el.tagName, old.tag))
+
+        for (k, v) in new.attrs.iteritems():
+            if old.attrs.get(k) != v:
+                self.ops += 1
+                if v is True:
+                    el.setAttribute(k, k)
+                else:
+                    el.setAttribute(k, str(v))
+                if k.lower() in ('value', 'checked', 'selected'):
+                    # The attribute is only the default once edited
+                    setattr(el, k.lower(), v)
+        for k in old.attrs:
+            if k not in new.attrs:
+                self.ops += 1
+                el.removeAttribute(k)
+                if k.lower() in ('checked', 'selected'):
+                    setattr(el, k.lower(), False)
+
+        self.patchKids(el, old.kids, new.kids)
+
+    def patchKids(self, el, old, new):
+        oldShape = [isinstance(kid, basestring) and kid for kid in old]
+        newShape = [isinstance(kid, basestring) and kid for kid in new]
+        if oldShape != newShape and (filter(None, oldShape) or filter(None, newShape)):
+            self.ops += 1
+            el.innerHTML = inner(new)
+            return
+        for kid in old:
+            if isinstance(kid, basestring) and '<' in kid:
+                # Markup in text, the elements in it aren't known here
+                if inner(old) != inner(new):
+                    self.ops += 1
+                    el.innerHTML = inner(new)
+                return
+
+        olds = [kid for kid in old if isinstance(kid, Node)]
+        news = [kid for kid in new if isinstance(kid, Node)]
+        children = el.children
+        if children.length != len(olds):
+            raise Mismatch("%d children where %d were rendered"%(children.length, len(olds)))
+
+        oldIds = set([kid.id for kid in olds if kid.id])
+        newIds = set([kid.id for kid in news if kid.id])
+        if [kid.id for kid in olds if kid.id in newIds] != [kid.id for kid in news if kid.id in oldIds]:
+            # Reordered, as by a sort, which would patch nearly every row
+            self.ops += 1
+            el.innerHTML = inner(new)
+            return
+        (i, j, pos) = (0, 0, 0)
+        while i < len(olds) and j < len(news):
+            (o, n) = (olds[i], news[j])
+            if o.id != n.id and n.id and n.id not in oldIds:
+                self.ops += 1
+                children.item(pos).insertAdjacentHTML('beforebegin', str(n))
+                pos += 1
+                j += 1
+            elif o.id != n.id and o.id and o.id not in newIds:
+                self.ops += 1
+                el.removeChild(children.item(pos))
+                i += 1
+            else:
+                self.patch(children.item(pos), o, n)
+                pos += 1
+                i += 1
+                j += 1
+        while i < len(olds):
+            self.ops += 1
+            el.removeChild(children.item(pos))
+            i += 1
+        while j < len(news):
+            self.ops += 1
+            el.insertAdjacentHTML('beforeend', str(news[j]))
+            j += 1
+
+################################################################################
+##
+##  TC_Patcher
+##
+##  The DOM here is a small stand-in that builds elements from HTML the
+##  way a browser would for the markup htmltags makes, TBODY included, so
+##  a patched element can be compared with a fully rendered one.
+##
+################################################################################
+class FakeChildren(object):
+    def __init__(self, el):
+        self.el = el
+    def _elements(self):
+        return [kid for kid in self.el.nodes if isinstance(kid, FakeElement)]
+    def item(self, i):
+        return self._elements()[i]
+    length = property(lambda self: len(self._elements()))
+
+class FakeElement(object):
+    def __init__(self, tag, attrs=(), parent=None):
+        self.__dict__['tagName'] = tag.upper()
+        self.__dict__['attrs']   = dict(attrs)
+        self.__dict__['nodes']   = []
+        self.__dict__['parent']  = parent
+        self.__dict__['doc']     = None
+
+    def __setattr__(self, key, val):
+        if key == 'innerHTML':
+            self.nodes[:] = self.doc.parse(val, self)
+            self.doc.ops += 1
+        elif key == 'outerHTML':
+            nodes = self.doc.parse(val, self.parent)
+            i = self.parent.nodes.index(self)
+            self.parent.nodes[i:i+1] = nodes
+            self.doc.ops += 1
+        else:
+            self.__dict__[key] = val
+
+    children = property(lambda self: FakeChildren(self))
+
+    def setAttribute(self, k, v):
+        self.attrs[k.lower()] = v
+    def removeAttribute(self, k):
+        self.attrs.pop(k.lower(), None)
+    def removeChild(self, kid):
+        self.nodes.remove(kid)
+    def insertAdjacentHTML(self, where, html):
+        if where == 'beforeend':
+            self.nodes.extend(self.doc.parse(html, self))
+        else:
+            i = self.parent.nodes.index(self)
+            self.parent.nodes[i:i] = self.doc.parse(html, self.parent)
+
+    def dump(self):
+        attrs = sorted(self.attrs.items())
+        return (self.tagName, attrs, [isinstance(kid, FakeElement) and kid.dump() or kid.strip()
+                for kid in self.nodes if not isinstance(kid, basestring) or kid.strip()])
+
+class FakeDocument(HTMLParser.HTMLParser):
+    VOID = set([tag.lower() for tag in htmltags.NON_CLOSING_TAGS])
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.root = FakeElement('div')
+        self.root.doc = self
+        self.ops = 0
+
+    def getElementById(self, elementId):
+        return self.root
+
+    def parse(self, html, parent):
+        self.reset()
+        self.top = FakeElement('fragment', parent=parent)
+        self.top.doc = self
+        self.stack = [self.top]
+        self.feed(html)
+        self.close()
+        for kid in self.top.nodes:
+            if isinstance(kid, FakeElement):
+                kid.parent = parent
+        return self.top.nodes
+
+    def handle_starttag(self, tag, attrs):
+        top = self.stack[-1]
+        if tag == 'tr' and top.tagName == 'TABLE':
+            body = FakeElement('tbody', parent=top)
+            body.doc = self
+            top.nodes.append(body)
+            self.stack.append(body)
+            top = body
+        el = FakeElement(tag, [(k, v is None and k or v) for (k, v) in attrs], parent=top)
+        el.doc = self
+        top.nodes.append(el)
+        if tag not in self.VOID:
+            self.stack.append(el)
+
+    def handle_endtag(self, tag):
+        while len(self.stack) > 1:
+            el = self.stack.pop()
+            if el.tagName == tag.upper():
+                break
+
+    def handle_data(self, data):
+        self.stack[-1].nodes.append(data)
+
+class TC_Patcher(unittest.TestCase):
+    def table(self, rows, mark=None):
+        root = htmltags.DIV(id='root')
+        tbl = htmltags.TABLE(id='tbl')
+        tr = htmltags.TR(id='hdr')
+        tr <= htmltags.TH() <= 'Vin'
+        tr <= htmltags.TH() <= 'Owner'
+        tbl <= tr
+        for (vin, owner) in rows:
+            tr = htmltags.TR(id='row+%s'%vin)
+            tr <= htmltags.TD(Class=(vin == mark) and 'mark' or 'plain') <= vin
+            td = htmltags.TD()
+            td <= htmltags.INPUT(type='text', id='own+%s'%vin, value=owner)
+            tr <= td
+            tbl <= tr
+        root <= tbl
+        root <= htmltags.P() <= htmltags.B('%d rows'%len(rows)) + ' listed'
+        return root
+
+    def full(self, tree):
+        doc = FakeDocument()
+        doc.root.innerHTML = str(tree)
+        return doc.root.dump()
+
+    def check(self, trees):
+        doc = FakeDocument()
+        view = Patcher(doc, 'content')
+        ops = []
+        for tree in trees:
+            view.render(tree)
+            ops.append(view.ops)
+            self.assertEqual(doc.root.dump(), self.full(tree))
+        self.assertEqual(view.fallbacks, 0)
+        return ops
+
+    def test_patch(self):
+        rows = [('car%02d'%n, 'owner %d'%n) for n in range(0, 20)]
+        ops = self.check([
+            self.table(rows),
+            self.table(rows, mark='car05'),
+            self.table(rows[:7] + [('car07', 'someone')] + rows[8:]),
+            self.table(rows[:3] + [('car03a', 'new')] + rows[3:]),
+            self.table(rows[:3] + rows[4:]),
+            self.table(rows + [('car99', 'last')]),
+            self.table(rows[:2]),
+            self.table(rows[:2]),
+            self.table(rows[1::-1]),
+        ])
+        # Full render, one class, class back and one value, an insert with
+        # its count and the value back, two removes with the count, two
+        # inserts with the count, 19 removes with the count, nothing, a
+        # reorder
+        self.assertEqual(ops, [1, 1, 2, 3, 3, 3, 20, 0, 1])
+
+    def test_checked(self):
+        doc = FakeDocument()
+        view = Patcher(doc, 'content')
+        for flag in (False, True, False):
+            view.render(htmltags.INPUT(type='checkbox', id='c', CHECKED=flag))
+            self.assertEqual(getattr(doc.root.children.item(0), 'checked', False), flag)
+
+    def test_empty_table(self):
+        self.check([self.table([]), self.table([('a', 'b')]), self.table([])])
+
+    def test_fallback(self):
+        doc = FakeDocument()
+        view = Patcher(doc, 'content')
+        view.render(self.table([('a', 'b')]))
+        # Rows added behind the view's back
+        doc.root.children.item(0).children.item(0).children.item(0).insertAdjacentHTML(
+                'beforebegin', '<tr><td>x</td></tr>')
+        tree = self.table([('a', 'c')])
+        view.render(tree)
+        self.assertEqual(view.fallbacks, 1)
+        self.assertEqual(doc.root.dump(), self.full(tree))
+
+    def test_logged(self):
+        doc = FakeDocument()
+        logged = []
+        view = Patcher(doc, 'content', log=logged.append)
+        view.render(self.table([('a', 'b')]))
+        # A row taken out behind the view's back is a mismatch
+        tbody = doc.root.children.item(0).children.item(0).children.item(0)
+        tbody.removeChild(tbody.children.item(1))
+        view.render(self.table([('a', 'c')]))
+        self.assertEqual((view.fallbacks, logged), (1, []))
+        # Anything else is logged, and still rendered in full
+        def broken(k, v):
+            raise TypeError('no attributes')
+        doc.root.children.item(0).children.item(0).children.item(0).children.item(1) \
+                .children.item(1).children.item(0).__dict__['setAttribute'] = broken
+        tree = self.table([('a', 'd')])
+        view.render(tree)
+        self.assertEqual(view.fallbacks, 2)
+        self.assertEqual(logged, ['Patcher.render() TypeError: no attributes'])
+        self.assertEqual(doc.root.dump(), self.full(tree))
+
+    def test_key(self):
+        doc = FakeDocument()
+        view = Patcher(doc, 'content')
+        view.render(self.table([('a', 'b')]), key='one')
+        view.render(self.table([('a', 'b')]), key='two')
+        self.assertEqual((view.ops, view.fallbacks), (1, 0))
+        view.render(htmltags.P('text') + htmltags.HR(), key='two')
+        self.assertEqual(doc.root.dump(), self.full(htmltags.P('text') + htmltags.HR()))
+
+##############################################################################
+##
+##  main
+##
+##############################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+################################################################################
+##
+##  ppnatlas.py
+##
+##  Schedules for the common race sizes, precomputed into one binary file
+##  (see extras/mkatlas.py) that ships in Resources. The file is memory
+##  mapped and each lookup only reads the generators and heat order of the
+##  schedule asked for, so nothing has to be generated.
+##
+################################################################################
+import array
+import mmap
+import os
+import os.path
+import struct
+import sys
+import tempfile
+import unittest
+import ppngen
+
+# The weight presets the bundled atlas covers, all three weights alike
+PRESETS = (ppngen.Weight.LIGHT, ppngen.Weight.MEDIUM, ppngen.Weight.HEAVY)
+
+################################################################################
+##
+##  PpnAtlas
+##
+##  Layout, all little endian:
+##
+##  header  -- magic, version, maxLanes, maxCars, maxRounds, nWeights,
+##             nEntries, nValues
+##  weights -- nWeights (W1, W2, W3) triples, uint16
+##  index   -- entry number, 0 for none, by lanes, cars, rounds, weights;
+##             uint32
+##  entries -- (gens offset, gens count, order offset, order count) into
+##             values, uint32. An order count of 0 is the base order.
+##  values  -- uint16
+##
+##  Identical schedules share an entry, and identical generator or order
+##  runs share their values, so sizes with more lanes than cars and
+##  presets that order the same way cost nothing extra.
+##
+################################################################################
+class PpnAtlas(object):
+    MAGIC   = 'PPNA'
+    VERSION = 1
+    HEADER  = '<4sHHHHHII'
+
+    def __init__(self, buf):
+        (magic, version, self.maxLanes, self.maxCars, self.maxRounds, nWeights,
+                self.nEntries, nValues) = struct.unpack_from(self.HEADER, buf)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ppngen.PpnException("Not a version %d schedule atlas"%self.VERSION)
+
+        self.buf = buf
+        offset = struct.calcsize(self.HEADER)
+        w = ppngen.MappedArray(buf, offset, 'H', 3 * nWeights)
+        self.weights = dict([(tuple(w[3*k:3*(k+1)]), k) for k in range(0, nWeights)])
+        offset += 6 * nWeights
+        nIndex = (self.maxLanes + 1) * (self.maxCars + 1) * (self.maxRounds + 1) * nWeights
+        self.index = ppngen.MappedArray(buf, offset, 'I', nIndex)
+        offset += 4 * nIndex
+        self.entries = ppngen.MappedArray(buf, offset, 'I', 4 * self.nEntries)
+        offset += 16 * self.nEntries
+        self.values = ppngen.MappedArray(buf, offset, 'H', nValues)
+
+    # Position in the index of a size and weights number
+    @staticmethod
+    def slot(maxCars, maxRounds, nWeights, nLanes, nCars, nRounds, w):
+        n = (nLanes * (maxCars + 1)) + nCars
+        n = (n * (maxRounds + 1)) + nRounds
+        return (n * nWeights) + w
+
+    ############################################################################
+    ##  Generates every schedule for lanes x cars x rounds x weights, where
+    ##  weights are (W1, W2, W3) triples. progress, if given, is called with
+    ##  each size as it is done.
+    ############################################################################
+    @classmethod
+    def build(cls, lanes, cars, rounds, weights, progress=None):
+        weights = [tuple(w) for w in weights]
+        maxLanes  = max(lanes)
+        maxCars   = max(cars)
+        maxRounds = max(rounds)
+
+        index = array.array('I', [0] * ((maxLanes + 1) * (maxCars + 1) * (maxRounds + 1) * len(weights)))
+        entries = array.array('I')
+        values = array.array('H')
+        runs = {}
+        known = {}
+
+        def place(run):
+            # Offset of run in values, shared with an identical earlier run
+            key = array.array('H', run).tostring()
+            if key not in runs:
+                runs[key] = len(values)
+                values.extend(run)
+            return runs[key]
+
+        for nLanes in lanes:
+            for nCars in cars:
+                for nRounds in rounds:
+                    for w in range(0, len(weights)):
+                        ppn = ppngen.Ppn(nLanes, nCars)
+                        ppn.nRounds = nRounds
+                        (ppn.W1, ppn.W2, ppn.W3) = weights[w]
+                        ppn.useNumpy = True
+                        ppn.generate()
+                        sched = ppn.makeSchedule()
+
+                        order = ()
+                        if sched.order is not None:
+                            order = tuple(sched.order)
+                        key = (sched.gens, order)
+                        if key not in known:
+                            entries.extend((place(sched.gens), len(sched.gens),
+                                            place(order), len(order)))
+                            known[key] = len(entries) / 4
+                        index[cls.slot(maxCars, maxRounds, len(weights), nLanes, nCars, nRounds, w)] = known[key]
+                if progress:
+                    progress(nLanes, nCars)
+
+        wt = array.array('H')
+        for w in weights:
+            wt.extend(w)
+        if sys.byteorder != 'little':
+            for a in (wt, index, entries, values):
+                a.byteswap()
+        header = struct.pack(cls.HEADER, cls.MAGIC, cls.VERSION, maxLanes, maxCars,
+                maxRounds, len(weights), len(entries) / 4, len(values))
+        return cls(header + wt.tostring() + index.tostring() + entries.tostring() + values.tostring())
+
+    @classmethod
+    def load(cls, filename):
+        fh = open(filename, 'rb')
+        try:
+            buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+        return cls(buf)
+
+    def save(self, filename):
+        fh = open(filename, 'wb')
+        fh.write(self.buf[:])
+        fh.close()
+
+    # Returns the ppngen.Schedule for the size and weights, or None if the
+    # atlas doesn't cover them
+    def lookup(self, nLanes, nCars, nRounds=1, W1=0, W2=0, W3=0):
+        w = self.weights.get((W1, W2, W3))
+        if w is None:
+            return None
+        if not (0 <= nLanes <= self.maxLanes and 0 <= nCars <= self.maxCars and 0 <= nRounds <= self.maxRounds):
+            return None
+        entry = self.index[self.slot(self.maxCars, self.maxRounds, len(self.weights),
+                nLanes, nCars, nRounds, w)]
+        if not entry:
+            return None
+
+        (oG, nG, oO, nO) = self.entries[4 * (entry - 1):4 * entry]
+        order = None
+        if nO:
+            order = self.values[oO:oO + nO]
+        return ppngen.Schedule(min(nLanes, nCars), nCars, self.values[oG:oG + nG], order)
+
+################################################################################
+##
+##  TC_PpnAtlas
+##
+################################################################################
+class TC_PpnAtlas(unittest.TestCase):
+    def generate(self, nLanes, nCars, nRounds, W):
+        ppn = ppngen.Ppn(nLanes, nCars)
+        ppn.nRounds = nRounds
+        (ppn.W1, ppn.W2, ppn.W3) = W
+        return ppn.generate()
+
+    def test_lookup(self):
+        W = ((1,1,1), (100,100,100), (0,0,0), (1,10,100))
+        atlas = PpnAtlas.build(range(2, 7), range(2, 21), (1, 2), W)
+        (fd, fname) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            atlas.save(fname)
+            for atlas in (atlas, PpnAtlas.load(fname)):
+                for (l,c,r) in ((2,2,1),(6,3,1),(4,13,2),(6,17,1),(5,20,2)):
+                    for w in W:
+                        self.assertEqual(self.generate(l, c, r, w), list(atlas.lookup(l, c, r, *w)))
+                self.assertEqual(None, atlas.lookup(4, 21, 1, 1, 1, 1))
+                self.assertEqual(None, atlas.lookup(4, 13, 3, 1, 1, 1))
+                self.assertEqual(None, atlas.lookup(4, 13, 1, 10, 10, 10))
+        finally:
+            os.unlink(fname)
+
+    def test_shared(self):
+        # More lanes than cars runs the same schedule as lanes == cars
+        atlas = PpnAtlas.build((3, 4, 5), (3,), (1,), ((10,10,10),))
+        self.assertEqual(atlas.nEntries, 1)
+
+##############################################################################
+##
+##  main
+##
+##############################################################################
+if __name__ == '__main__':
+    unittest.main()
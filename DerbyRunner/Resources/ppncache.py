@@ -0,0 +1,504 @@
+#! /usr/bin/env python
+################################################################################
+##
+##  ppncache.py
+##
+################################################################################
+import collections
+import heapq
+import os
+import os.path
+import tempfile
+import threading
+import time
+import unittest
+import derbydata
+import ppngen
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+# Worker processes for generateMany. None uses one per CPU, 1 generates in
+# this process.
+PROCESSES = None
+
+################################################################################
+##
+##  ScheduleCache
+##
+##  Ppn.generate is a pure function of lanes, cars, rounds, the three
+##  weights and the seconds spent optimizing the order, so its heats are
+##  kept in a small in-process LRU backed by an
+##  on-disk derbydata.Database. Both levels are bounded; the disk store
+##  evicts the least recently used schedule. Schedules are kept as
+##  ppngen.Schedule objects, the generators and heat order only.
+##
+##  The time each disk schedule was last used is kept in memory, with a
+##  heap to find the oldest, and saved in the single STAMPS record when a
+##  schedule is stored. A disk hit only reads its record.
+##
+################################################################################
+class ScheduleCache(object):
+    STAMPS = '#stamps'
+
+    def __init__(self, filename=None, maxMemory=32, maxDisk=500):
+        self.maxMemory = maxMemory
+        self.maxDisk   = maxDisk
+        self.memory    = collections.OrderedDict()
+        self.disk      = None
+        self.stamp     = 0.0
+        self.stamps    = None
+        self.heap      = []
+        if filename:
+            self.disk = derbydata.Database(filename)
+
+        # Statistics
+        self.hits     = 0
+        self.diskHits = 0
+        self.misses   = 0
+
+    def __len__(self):
+        return len(self.memory)
+
+    def key(self, nLanes, nCars, nRounds, W1, W2, W3, optimize=0):
+        # Ppn never runs more lanes than cars
+        nLanes = min(nLanes, nCars)
+        key = '%d,%d,%d,%s,%s,%s'%(nLanes, nCars, nRounds, W1, W2, W3)
+        if optimize:
+            key += ',%s'%optimize
+        return key
+
+    def generate(self, nLanes, nCars, nRounds=1, W1=0, W2=0, W3=0, optimize=0):
+        return list(self.iterHeats(nLanes, nCars, nRounds, W1, W2, W3, optimize))
+
+    # Yields the heats one at a time. On a miss they come straight from
+    # Ppn.iterHeats as the ordering commits them, and the schedule is only
+    # cached once it has been read to the end. With optimize they only come
+    # once the order is optimized.
+    def iterHeats(self, nLanes, nCars, nRounds=1, W1=0, W2=0, W3=0, optimize=0):
+        (nLanes, nCars, nRounds, W1, W2, W3, optimize) = self.request(
+                nLanes, nCars, nRounds, W1, W2, W3, optimize)
+        key = self.key(nLanes, nCars, nRounds, W1, W2, W3, optimize)
+
+        heats = self.lookup(key)
+        if heats is None:
+            self.misses += 1
+            ppn = ppngen.Ppn(nLanes, nCars)
+            ppn.nRounds = nRounds
+            ppn.W1 = W1
+            ppn.W2 = W2
+            ppn.W3 = W3
+            ppn.optimize = optimize
+            ppn.useNumpy = True
+            for heat in ppn.iterHeats():
+                yield list(heat)
+            heats = ppn.makeSchedule()
+            self.store(key, heats)
+            self.remember(key, heats)
+        else:
+            for heat in heats:
+                yield list(heat)
+
+    ############################################################################
+    ##  Generates the heats for a list of (nLanes, nCars, nRounds, W1, W2,
+    ##  W3, optimize) requests, trailing values defaulting as in generate. Identical
+    ##  sizes are only generated once, and the ones not already cached are
+    ##  spread over a pool of worker processes. Returns the heats for each
+    ##  request, in request order.
+    ############################################################################
+    def generateMany(self, requests, processes=None):
+        (keys, found, todo) = self.plan(requests)
+        results = _generateAll(_generate, [req for (key, req) in todo], processes)
+        found.update(self.commit(todo, results))
+        return [[list(heat) for heat in found[key]] for key in keys]
+
+    ############################################################################
+    ##  generateMany on a Batch thread, for a page that can't wait for it.
+    ##  The thread only generates; the cache itself is only touched here and
+    ##  in finishMany, which the page calls once the batch is done. Returns
+    ##  the started Batch, or None when everything is cached already.
+    ############################################################################
+    def startMany(self, requests, processes=None):
+        (keys, found, todo) = self.plan(requests)
+        if not todo:
+            return None
+        batch = Batch(todo, processes)
+        batch.start()
+        return batch
+
+    def finishMany(self, batch):
+        if batch.results is not None:
+            self.commit(batch.todo, batch.results)
+
+    # (keys, {key : cached heats}, [(key, request) to generate]) for the
+    # requests, with identical ones only taken once
+    def plan(self, requests):
+        requests = [self.request(*req) for req in requests]
+        keys = [self.key(*req) for req in requests]
+
+        found = {}
+        todo = []
+        for (key, req) in zip(keys, requests):
+            if key in found:
+                continue
+            found[key] = self.lookup(key)
+            if found[key] is None:
+                todo.append((key, req))
+        return (keys, found, todo)
+
+    # Caches the generated results, None for a request that failed, and
+    # returns them as {key : Schedule}
+    def commit(self, todo, results):
+        found = {}
+        for ((key, req), result) in zip(todo, results):
+            if result is None:
+                continue
+            (nLanes, nCars, gens, order) = result
+            self.misses += 1
+            heats = ppngen.Schedule(nLanes, nCars, gens, order)
+            found[key] = heats
+            self.store(key, heats)
+            self.remember(key, heats)
+        return found
+
+    # The request in full. Ppn only optimizes an order that has weights to
+    # optimize, so without any it's the same request as no optimizing.
+    def request(self, nLanes, nCars, nRounds=1, W1=0, W2=0, W3=0, optimize=0):
+        if not (W1 + W2 + W3):
+            optimize = 0
+        return (nLanes, nCars, nRounds, W1, W2, W3, optimize)
+
+    def lookup(self, key):
+        heats = self.memory.get(key)
+        if heats is not None:
+            self.hits += 1
+        else:
+            heats = self.load(key)
+            if heats is None:
+                return None
+            self.hits += 1
+            self.diskHits += 1
+        self.remember(key, heats)
+        return heats
+
+    def remember(self, key, heats):
+        self.memory.pop(key, None)
+        self.memory[key] = heats
+        while len(self.memory) > self.maxMemory:
+            self.memory.popitem(last=False)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            for key in self.disk.keys():
+                del self.disk[key]
+            self.stamps = {}
+            self.heap = []
+
+    ############################################################################
+    ##  The {key : time of last use} of the disk schedules, read from the
+    ##  STAMPS record on first use.
+    ############################################################################
+    def index(self):
+        if self.stamps is None:
+            self.stamps = {}
+            for line in self.disk.get(self.STAMPS, '').split('\n'):
+                if line:
+                    (stamp, key) = line.split(' ', 1)
+                    self.stamps[key] = float(stamp)
+            self.heap = [(stamp, key) for (key, stamp) in self.stamps.iteritems()]
+            heapq.heapify(self.heap)
+        return self.stamps
+
+    # Marks key as used now. Older heap entries for it are skipped when
+    # they come up, and dropped once they outnumber the live ones.
+    def touch(self, key):
+        stamps = self.index()
+        self.stamp = max(time.time(), self.stamp + 0.000001)
+        stamps[key] = self.stamp
+        heapq.heappush(self.heap, (self.stamp, key))
+        if len(self.heap) > 2 * len(stamps) + 16:
+            self.heap = [(stamp, k) for (k, stamp) in stamps.iteritems()]
+            heapq.heapify(self.heap)
+
+    ############################################################################
+    ##  Disk records are "stamp|lanes,cars|gens|order" where stamp is the
+    ##  time the schedule was stored and order is empty for the base order.
+    ############################################################################
+    def load(self, key):
+        if self.disk is None:
+            return None
+        try:
+            val = self.disk[key]
+        except KeyError:
+            return None
+
+        (stamp, size, gens, order) = val.split('|')
+        (nLanes, nCars) = [int(x) for x in size.split(',')]
+        gens = [int(x) for x in gens.split(',')]
+        if order:
+            order = [int(x) for x in order.split(',')]
+        else:
+            order = None
+        heats = ppngen.Schedule(nLanes, nCars, gens, order)
+        self.touch(key)
+        return heats
+
+    def store(self, key, heats):
+        if self.disk is None:
+            return
+        self.touch(key)
+
+        stamps = self.index()
+        while len(stamps) > self.maxDisk:
+            (stamp, k) = heapq.heappop(self.heap)
+            if stamps.get(k) == stamp:
+                del stamps[k]
+                try:
+                    del self.disk[k]
+                except KeyError:
+                    pass
+
+        txt = ['%r %s'%(stamp, k) for (k, stamp) in stamps.iteritems()]
+        self.disk.update([(key, self.record(heats)), (self.STAMPS, '\n'.join(txt))])
+
+    def record(self, heats):
+        order = ''
+        if heats.order is not None:
+            order = ','.join([str(j) for j in heats.order])
+        return '%r|%d,%d|%s|%s'%(self.stamp, heats.nLanes, heats.nCars,
+                ','.join([str(g) for g in heats.gens]), order)
+
+################################################################################
+##
+##  Batch
+##
+##  Generates the todo list of a ScheduleCache.startMany on a thread of
+##  its own. done is set once results, one per request, are in.
+##
+################################################################################
+class Batch(object):
+    def __init__(self, todo, processes=None):
+        self.todo      = todo
+        self.processes = processes
+        self.thread    = None
+        self.results   = None
+        self.done      = False
+        self.elapsed   = 0.0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='Batch')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        start = time.time()
+        try:
+            self.results = _generateAll(_tryGenerate,
+                    [req for (key, req) in self.todo], self.processes)
+        finally:
+            self.elapsed = time.time() - start
+            self.done = True
+
+# Maps func over the requests, in a pool of worker processes when there
+# is more than one and the processes allow it
+def _generateAll(func, reqs, processes):
+    if processes is None:
+        processes = PROCESSES
+    if len(reqs) > 1 and processes != 1 and multiprocessing:
+        try:
+            pool = multiprocessing.Pool(processes)
+        except Exception:
+            pool = None
+        if pool:
+            try:
+                return pool.map(func, reqs)
+            finally:
+                pool.terminate()
+    return map(func, reqs)
+
+# A Batch skips the requests that can't be generated, such as too many
+# lanes, and leaves them to fail when they're asked for on their own
+def _tryGenerate(req):
+    try:
+        return _generate(req)
+    except ppngen.PpnException:
+        return None
+
+# Runs in the worker processes of generateMany. Only the generators and
+# the heat order come back, the parent rebuilds the Schedule.
+def _generate(req):
+    (nLanes, nCars, nRounds, W1, W2, W3, optimize) = req
+    ppn = ppngen.Ppn(nLanes, nCars)
+    ppn.nRounds = nRounds
+    ppn.W1 = W1
+    ppn.W2 = W2
+    ppn.W3 = W3
+    ppn.optimize = optimize
+    ppn.useNumpy = True
+    ppn.generate()
+    sched = ppn.makeSchedule()
+    order = None
+    if sched.order is not None:
+        order = sched.order.tolist()
+    return (sched.nLanes, sched.nCars, sched.gens, order)
+
+################################################################################
+##
+##  TC_ScheduleCache
+##
+################################################################################
+class TC_ScheduleCache(unittest.TestCase):
+    filename = None
+
+    def setUp(self):
+        (fd, self.filename) = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.filename)
+
+    def tearDown(self):
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+    def generate(self, nLanes, nCars, W1, W2, W3):
+        ppn = ppngen.Ppn(nLanes, nCars)
+        ppn.W1 = W1
+        ppn.W2 = W2
+        ppn.W3 = W3
+        return ppn.generate()
+
+    def test_memory(self):
+        cache = ScheduleCache()
+        want = self.generate(4, 13, 10, 10, 10)
+        self.assertEqual(want, cache.generate(4, 13, 1, 10, 10, 10))
+        self.assertEqual(want, cache.generate(4, 13, 1, 10, 10, 10))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_copy(self):
+        cache = ScheduleCache()
+        heats = cache.generate(3, 5)
+        heats[0][0] = 99
+        self.assertNotEqual(heats, cache.generate(3, 5))
+
+    def test_stream(self):
+        cache = ScheduleCache()
+        want = self.generate(5, 11, 10, 10, 10)
+        heats = cache.iterHeats(5, 11, 1, 10, 10, 10)
+        self.assertEqual(want[0], heats.next())
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(want[1:], list(heats))
+        self.assertEqual(want, cache.generate(5, 11, 1, 10, 10, 10))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_disk(self):
+        want = self.generate(6, 17, 1, 10, 100)
+        cache = ScheduleCache(self.filename)
+        self.assertEqual(want, cache.generate(6, 17, 1, 1, 10, 100))
+        cache = ScheduleCache(self.filename)
+        self.assertEqual(want, cache.generate(6, 17, 1, 1, 10, 100))
+        self.assertEqual((cache.hits, cache.diskHits, cache.misses), (1, 1, 0))
+
+    def test_schedule(self):
+        # Misses keep the compact form, older full records still load
+        cache = ScheduleCache(self.filename)
+        want = self.generate(5, 19, 1, 10, 100)
+        cache.generate(5, 19, 1, 1, 10, 100)
+        key = cache.key(5, 19, 1, 1, 10, 100)
+        self.assertTrue(isinstance(cache.memory[key], ppngen.Schedule))
+        self.assertEqual(len(cache.disk[key].split('|')), 4)
+
+        cache = ScheduleCache(self.filename)
+        self.assertEqual(want, cache.generate(5, 19, 1, 1, 10, 100))
+        self.assertEqual(cache.diskHits, 1)
+
+    def test_many(self):
+        reqs = [(4, 13, 1, 10, 10, 10), (6, 17), (4, 13, 1, 10, 10, 10),
+                (5, 13, 2, 1, 10, 100), (6, 17, 1, 0, 0, 0)]
+        for processes in (1, None):
+            cache = ScheduleCache()
+            cache.generate(5, 13, 2, 1, 10, 100)
+            got = cache.generateMany(reqs, processes)
+            self.assertEqual(len(got), len(reqs))
+            for (req, heats) in zip(reqs, got):
+                self.assertEqual(cache.generate(*req), heats)
+            self.assertEqual(cache.misses, 3)
+            got[0][0][0] = 99
+            self.assertNotEqual(got[0], got[2])
+
+    def test_batch(self):
+        reqs = [(4, 13, 1, 10, 10, 10), (6, 17), (7, 17), (5, 11, 1, 1, 10, 100)]
+        cache = ScheduleCache(self.filename)
+        cache.generate(6, 17)
+        batch = cache.startMany(reqs, processes=1)
+        self.assertEqual(len(cache), 1)
+        batch.thread.join()
+        self.assertTrue(batch.done)
+        self.assertEqual(batch.results[1], None)
+        cache.finishMany(batch)
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(cache.generate(4, 13, 1, 10, 10, 10), self.generate(4, 13, 10, 10, 10))
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(cache.startMany(reqs[:2]), None)
+
+    def test_optimize(self):
+        # An optimized order is cached apart from the greedy one, except
+        # without weights when there's nothing to optimize
+        cache = ScheduleCache(self.filename)
+        greedy = cache.generate(4, 30, 2, 1, 10, 100)
+        for (processes, optimize) in ((1, 0.1), (None, 0.2)):
+            batch = cache.startMany([(4, 30, 2, 1, 10, 100, optimize), (4, 30, 2, 1, 10, 100)], processes)
+            batch.thread.join()
+            cache.finishMany(batch)
+        self.assertEqual(cache.misses, 3)
+        heats = cache.generate(4, 30, 2, 1, 10, 100, 0.1)
+        self.assertEqual(cache.misses, 3)
+        for r in (0, 1):
+            self.assertEqual(sorted(greedy[r*30:(r+1)*30]), sorted(heats[r*30:(r+1)*30]))
+        self.assertEqual(cache.key(*cache.request(4, 30, 2, 0, 0, 0, 0.1)), cache.key(4, 30, 2, 0, 0, 0))
+        cache = ScheduleCache(self.filename)
+        self.assertEqual(heats, cache.generate(4, 30, 2, 1, 10, 100, 0.1))
+        self.assertEqual(cache.diskHits, 1)
+
+    def test_evict(self):
+        cache = ScheduleCache(self.filename, maxMemory=2, maxDisk=3)
+        for nCars in range(3, 8):
+            cache.generate(2, nCars)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(len(cache.index()), 3)
+        self.assertEqual(sorted(cache.disk.keys()),
+                sorted(cache.index().keys() + [ScheduleCache.STAMPS]))
+        cache.generate(2, 3)
+        self.assertEqual(cache.misses, 6)
+        cache.generate(2, 7)
+        self.assertEqual(cache.misses, 6)
+
+    def test_stamps(self):
+        # A disk hit only reads, and still counts as a use when evicting
+        cache = ScheduleCache(self.filename, maxMemory=0, maxDisk=3)
+        for nCars in range(3, 6):
+            cache.generate(2, nCars)
+        before = dict(cache.disk.iteritems())
+        cache = ScheduleCache(self.filename, maxMemory=0, maxDisk=3)
+        cache.generate(2, 3)
+        self.assertEqual(cache.diskHits, 1)
+        self.assertEqual(dict(cache.disk.iteritems()), before)
+
+        cache.generate(2, 6)
+        self.assertEqual(sorted(cache.index().keys()),
+                [cache.key(2, n, 1, 0, 0, 0) for n in (3, 5, 6)])
+        cache = ScheduleCache(self.filename, maxMemory=0, maxDisk=3)
+        self.assertEqual(cache.index().keys(), ScheduleCache(self.filename).index().keys())
+        cache.generate(2, 3)
+        self.assertEqual(cache.misses, 0)
+
+##############################################################################
+##
+##  main
+##
+##############################################################################
+if __name__ == '__main__':
+    unittest.main()
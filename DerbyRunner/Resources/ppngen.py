@@ -4,14 +4,27 @@
 ##  ppngen.py
 ##
 ################################################################################
+import array
+import mmap
+import operator
 import optparse
 import os
 import os.path
 import re
+import struct
 import subprocess
 import sys
+import tempfile
 import time
 import unittest
+import ppnopt
+import ppnsearch
+
+# NumPy is optional. Without it Ppn always orders heats in pure Python.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 ################################################################################
 ##  PPN_PARMS holds magic numbers derived from the original Young and Pope
@@ -241,8 +254,121 @@ class Weight(object):
 ##  makeArray
 ##
 ################################################################################
-def makeArray(n, init=0):
-    return [init] * (n+1)
+def makeArray(n, init=0, code='H'):
+    return array.array(code, [init]) * (n+1)
+
+################################################################################
+##
+##  heatCode
+##  Array type code wide enough for the numbers up to n
+##
+################################################################################
+def heatCode(n):
+    if n <= 0xFFFF:
+        return 'H'
+    return 'I'
+
+################################################################################
+##
+##  popcount
+##
+################################################################################
+def popcount(x):
+    return bin(x).count('1')
+
+################################################################################
+##
+##  firstBest
+##  The heat iterOrder would pick from an array of ratings: the last in the
+##  chain of heats that each beat the best so far by more than eps, or None
+##  if none beats 10000. Within a run of near ties that isn't always the
+##  first heat within eps of the minimum, so the chain is followed a step
+##  at a time, each step one array operation.
+##
+################################################################################
+def firstBest(rating, eps=0.000001):
+    (k, bRt, start) = (None, 10000, 0)
+    while True:
+        beats = numpy.flatnonzero(rating[start:] < (bRt - eps))
+        if not len(beats):
+            return k
+        k = start + beats[0]
+        bRt = rating[k]
+        start = k + 1
+
+################################################################################
+##
+##  HeatView
+##
+##  One heat of a schedule, read in place from the buffer it was ordered
+##  into rather than copied out of it. Indexes, iterates and compares like
+##  the list of cars it stands for.
+##
+################################################################################
+class HeatView(object):
+    __slots__ = ('buf', 'lo', 'n')
+
+    def __init__(self, buf, lo, n):
+        self.buf = buf
+        self.lo  = lo
+        self.n   = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.buf[self.lo + l] for l in range(*i.indices(self.n))]
+        if i < 0:
+            i += self.n
+        if not (0 <= i < self.n):
+            raise IndexError("heat index out of range")
+        return self.buf[self.lo + i]
+
+    def __iter__(self):
+        buf = self.buf
+        for l in range(self.lo, self.lo + self.n):
+            yield buf[l]
+
+    # Compares as the list of its cars, against lists, tuples, arrays or
+    # other views
+    def compare(self, other, op):
+        if not isinstance(other, (HeatView, list, tuple, array.array)):
+            return NotImplemented
+        return op(self.tolist(), list(other))
+
+    # The cars can change under the view, so it has no stable hash
+    __hash__ = None
+
+    def __eq__(self, other):
+        return self.compare(other, operator.eq)
+
+    def __ne__(self, other):
+        return self.compare(other, operator.ne)
+
+    def __lt__(self, other):
+        return self.compare(other, operator.lt)
+
+    def __le__(self, other):
+        return self.compare(other, operator.le)
+
+    def __gt__(self, other):
+        return self.compare(other, operator.gt)
+
+    def __ge__(self, other):
+        return self.compare(other, operator.ge)
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def count(self, car):
+        return self.tolist().count(car)
+
+    def index(self, car):
+        return self.tolist().index(car)
+
+    def tolist(self):
+        return self.buf[self.lo:self.lo + self.n].tolist()
 
 ################################################################################
 ##
@@ -258,6 +384,215 @@ def printHeats(heats):
             txt += " %3d"%lane
         print txt
 
+################################################################################
+##
+##  MappedArray
+##
+##  Read-only array of little-endian integers sitting at an offset in a
+##  string or mmap, so a saved PpnTable can be used without copying it.
+##
+################################################################################
+class MappedArray(object):
+    def __init__(self, buf, offset, typecode, length):
+        self.buf    = buf
+        self.offset = offset
+        self.code   = typecode
+        self.size   = struct.calcsize('<' + typecode)
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            # Unpack the span the slice covers, then step through it
+            idx = xrange(*i.indices(self.length))
+            if not idx:
+                return ()
+            lo = min(idx[0], idx[-1])
+            n = abs(idx[-1] - idx[0]) + 1
+            return struct.unpack_from('<%d%s'%(n, self.code), self.buf,
+                    self.offset + (lo * self.size))[idx[0] - lo::i.step or 1]
+        if i < 0:
+            i += self.length
+        if not (0 <= i < self.length):
+            raise IndexError(i)
+        return struct.unpack_from('<' + self.code, self.buf,
+                self.offset + (i * self.size))[0]
+
+################################################################################
+##
+##  PpnTable
+##
+##  PPN_PARMS compiled into a dense (lanes, cars) index so getParms is one
+##  lookup instead of a scan of the car ranges. The binary form is:
+##
+##  header  -- '<4sHHHII': 'PPNT', version, maxLanes, maxCars, entries, values
+##  index   -- uint16[(maxLanes+1) * (maxCars+1)], entry number + 1, 0 = none
+##  entries -- uint32[4 * entries]: T offset, T length, tg offset, tg length
+##  values  -- uint16[values], the T and tg numbers
+##
+################################################################################
+class PpnTable(object):
+    MAGIC   = 'PPNT'
+    VERSION = 1
+    HEADER  = '<4sHHHII'
+
+    def __init__(self, buf):
+        (magic, version, self.maxLanes, self.maxCars, nEntries, nValues) = \
+                struct.unpack_from(self.HEADER, buf)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise PpnException("Not a version %d parameter table"%self.VERSION)
+
+        self.buf = buf
+        offset = struct.calcsize(self.HEADER)
+        nIndex = (self.maxLanes + 1) * (self.maxCars + 1)
+        self.index = MappedArray(buf, offset, 'H', nIndex)
+        offset += 2 * nIndex
+        self.entries = MappedArray(buf, offset, 'I', 4 * nEntries)
+        offset += 16 * nEntries
+        self.values = MappedArray(buf, offset, 'H', nValues)
+
+    @classmethod
+    def compile(cls, parms):
+        maxLanes = len(parms) - 1
+        maxCars = max([hi for rows in parms if rows for (lo, hi, T, tg) in rows])
+
+        index = array.array('H', [0] * ((maxLanes + 1) * (maxCars + 1)))
+        entries = array.array('I')
+        values = array.array('H')
+        for nLanes in range(0, maxLanes + 1):
+            for (lo, hi, T, tg) in parms[nLanes] or ():
+                entries.extend((len(values), len(T), len(values) + len(T), len(tg)))
+                values.extend(T)
+                values.extend(tg)
+                for nCars in range(lo, hi + 1):
+                    index[(nLanes * (maxCars + 1)) + nCars] = len(entries) / 4
+
+        if sys.byteorder != 'little':
+            for a in (index, entries, values):
+                a.byteswap()
+        header = struct.pack(cls.HEADER, cls.MAGIC, cls.VERSION,
+                maxLanes, maxCars, len(entries) / 4, len(values))
+        return cls(header + index.tostring() + entries.tostring() + values.tostring())
+
+    @classmethod
+    def load(cls, filename):
+        fh = open(filename, 'rb')
+        try:
+            buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+        return cls(buf)
+
+    def save(self, filename):
+        fh = open(filename, 'wb')
+        fh.write(self.buf[:])
+        fh.close()
+
+    def lookup(self, nLanes, nCars):
+        if not (0 <= nLanes <= self.maxLanes and 0 <= nCars <= self.maxCars):
+            return None
+        entry = self.index[(nLanes * (self.maxCars + 1)) + nCars]
+        if not entry:
+            return None
+        (oT, nT, oTg, nTg) = self.entries[4 * (entry - 1):4 * entry]
+        return (self.values[oT:oT + nT], self.values[oTg:oTg + nTg])
+
+################################################################################
+##
+##  Schedule
+##
+##  A generated schedule held implicitly. Heat j of the base schedule runs
+##  car c = (j % nCars) + 1 in lane 0 and car c + marks[r][l] in lane l,
+##  taken mod nCars, where r is the round of j and marks[r] are the running
+##  totals of that round's generators. Ordering only permutes the heats, so
+##  the generators and order[h] (the base heat run h-th, None for the base
+##  order) are all that's stored. Heats are worked out as they are read.
+##
+################################################################################
+class Schedule(object):
+    __slots__ = ('nLanes', 'nCars', 'nHeats', 'gens', 'order', 'marks')
+
+    def __init__(self, nLanes, nCars, gens, order=None):
+        self.nLanes = nLanes
+        self.nCars  = nCars
+        self.gens   = tuple(gens)
+        gS = nLanes - 1
+        nRounds = len(self.gens) / gS
+        self.nHeats = nCars * nRounds
+
+        self.order = None
+        if order is not None:
+            self.order = array.array(heatCode(self.nHeats), order[:self.nHeats])
+
+        self.marks = []
+        for r in range(0, nRounds):
+            m = [0]
+            for g in self.gens[r*gS:(r+1)*gS]:
+                m.append(m[-1] + g)
+            self.marks.append(tuple(m))
+
+    def __len__(self):
+        return self.nHeats
+
+    def base(self, h):
+        if not (0 <= h < self.nHeats):
+            raise IndexError("heat index out of range")
+        if self.order is None:
+            return h
+        return self.order[h]
+
+    def car(self, h, l):
+        j = self.base(h)
+        return ((j + self.marks[j / self.nCars][l]) % self.nCars) + 1
+
+    def __getitem__(self, h):
+        if isinstance(h, slice):
+            return [self[x] for x in range(*h.indices(self.nHeats))]
+        if h < 0:
+            h += self.nHeats
+        j = self.base(h)
+        c = j % self.nCars
+        return [((c + m) % self.nCars) + 1 for m in self.marks[j / self.nCars]]
+
+    def __iter__(self):
+        for h in range(0, self.nHeats):
+            yield self[h]
+
+    def tolist(self):
+        return list(self)
+
+PPN_TABLE = None
+
+################################################################################
+##
+##  parmTable
+##
+##  The table used by Ppn.getParms, compiled from PPN_PARMS on first use.
+##  Assign a loaded PpnTable to PPN_TABLE to use a saved one instead.
+##
+################################################################################
+def parmTable():
+    global PPN_TABLE
+    if PPN_TABLE is None:
+        PPN_TABLE = PpnTable.compile(PPN_PARMS)
+    return PPN_TABLE
+
+################################################################################
+##
+##  distinctRounds
+##  Rounds of distinct heats the tables hold for a size, None past the end
+##  of the tables where the generators are searched for instead. Rounds
+##  past these repeat them.
+##
+################################################################################
+def distinctRounds(nLanes, nCars):
+    parms = parmTable().lookup(min(nLanes, nCars), nCars)
+    if parms is None:
+        return None
+    return len(parms[0])
+
 ################################################################################
 ##
 ##  Ppn
@@ -267,8 +602,8 @@ class Ppn(object):
     def __init__(self, nLanes, nCars):
         if not (2 <= nLanes <= 6):
             raise PpnException("Must have between 2 and 6 lanes")
-        if not (2 <= nCars <= 200):
-            raise ppnException("Must have between 2 and 200 cars")
+        if not (2 <= nCars):
+            raise PpnException("Must have at least 2 cars")
 
         # Numbers of lanes and cars
         self.nLanes = nLanes
@@ -282,38 +617,104 @@ class Ppn(object):
         self.W2 = 0     # Avoid consecutive heats
         self.W3 = 0     # Avoid consecutive lanes
 
-        # Internal variables
+        # Score all candidate heats at once with NumPy when it's available
+        self.useNumpy = False
+
+        # Seconds to spend improving the greedy order with ppnopt, 0 = off.
+        # Afterwards objective holds the (before, after) totals.
+        self.optimize  = 0
+        self.restarts  = 1
+        self.objective = None
+
+        # Internal variables. The schedule buffers are typed arrays, with
+        # wider items only for more cars than fit in 16 bits.
+        self.code = heatCode(nCars)
         self.pn  = None
         self.pn2 = None
         self.T   = None
         self.tg  = None
+        self.sumSq = 0
+        self.dups  = None
+        self.order = None
+        self.bits  = None
+        self.lanes = None
+        self.pick  = None
+        self.low   = 0
+        self.high  = 0
 
     # Main function
     def generate(self):
-        (T, tg) = self.getParms()
+        self.makeBase()
+        self.orderRaces()
+        if self.optimize and (self.W1 + self.W2 + self.W3):
+            self.improve()
+        heats = self.makeHeats()
+
+        return heats
+
+    # Same heats as generate, but each one is yielded as soon as the
+    # ordering commits it to its slot. With optimize set the whole order
+    # has to be known first.
+    def iterHeats(self):
+        if self.optimize:
+            for heat in self.generate():
+                yield heat
+            return
+
+        self.makeBase()
+        for i in self.iterOrder():
+            yield HeatView(self.pn2, self.nLanes * i, self.nLanes)
+
+    def improve(self):
+        opt = ppnopt.Optimizer(self.makeHeats(), self.nCars,
+                self.W1, self.W2, self.W3, block=self.nCars)
+        heats = opt.run(self.optimize, self.restarts)
 
-        if self.nRounds > len(T):
-            print "Only up to %d rounds allowed for %d cars on %d lanes"%(len(T), nCars, nLanes)
-            self.nRounds = len(T)
+        # The optimizer moves whole heats, find where each one came from.
+        # Identical heats each take one of the places they could have
+        # come from, so order stays a permutation.
+        nL = self.nLanes
+        where = {}
+        for j in range(self.nHeats - 1, -1, -1):
+            where.setdefault(self.pn[nL * j:nL * (j+1)].tostring(), []).append(j)
+        for i in range(0, self.nHeats):
+            heat = array.array(self.code, heats[i])
+            self.pn2[(nL * i):(nL * (i+1))] = heat
+            self.order[i] = where[heat.tostring()].pop()
+        self.objective = (opt.before, opt.after)
+
+    # The ordered heats as a Schedule, which keeps only the generators and
+    # the order instead of every car of every heat
+    def makeSchedule(self):
+        gens = self.gens[1:1 + (self.gS * self.nRounds)]
+        return Schedule(self.nLanes, self.nCars, gens, self.order)
+
+    def makeBase(self, parms=None):
+        if parms is None:
+            parms = self.getParms()
+        (T, tg) = parms
+
+        # Each set of generators makes one round. There are often fewer
+        # sets than rounds, then later rounds reuse the sets in turn and
+        # run an earlier round again heat for heat, still every car once
+        # in every lane.
 
         self.gS     = self.nLanes - 1
-        self.gens   = makeArray(self.gS * self.nRounds)
+        self.gens   = makeArray(self.gS * self.nRounds, code=self.code)
         self.nHeats = self.nCars * self.nRounds
-        self.pn     = makeArray(self.nHeats * self.nLanes)
-        self.pn2    = makeArray(self.nHeats * self.nLanes)
+        self.pn     = makeArray(self.nHeats * self.nLanes, code=self.code)
+        self.pn2    = makeArray(self.nHeats * self.nLanes, code=self.code)
         self.hP     = (self.nHeats * self.nLanes) / self.nCars
         self.h2h    = (self.hP * (self.nLanes - 1)) / (self.nCars - 1);
-        self.sums   = makeArray(self.nCars)
+        self.sums   = makeArray(self.nCars, code=self.code)
 
-        aI = 0
         yI = 0
         for gL in range(0, self.nRounds):
-            tI = aI
+            tI = (gL % len(T)) * self.gS
             for dL in range(0, self.gS):
                 yI += 1
                 self.gens[yI] = tg[tI]
                 tI += 1
-            aI = tI
 
         aI = 1
         pI = 0
@@ -332,44 +733,186 @@ class Ppn(object):
                     pI += 1
             aI = tI
 
-        self.orderRaces()
-        heats = self.makeHeats()
-
-        return heats
-
     def orderRaces(self):
+        for i in self.iterOrder():
+            pass
+
+    ################################################################################
+    ##
+    ##  iterOrder
+    ##  Greedy ordering of the heats in pn into pn2. Yields each slot number
+    ##  once its heat is in place. Rounds are ordered one after another, each
+    ##  slot choosing only among the unused heats of its own round, so every
+    ##  round is complete before the next one starts.
+    ##
+    ################################################################################
+    def iterOrder(self):
         if (self.W1 + self.W2 + self.W3) == 0:
             self.pn2 = self.pn
+            self.order = None
+            for i in range(0, self.nHeats):
+                yield i
+        elif self.useNumpy and numpy:
+            for i in self.iterOrderNumpy():
+                yield i
         else:
             nU = makeArray(self.nHeats-1, init=1)
 
+            # Running sum of squared race counts, see check1
+            self.sumSq = 0
+            self.dups  = [self.dupPairs(j) for j in range(0, self.nHeats)]
+            self.makeMasks()
+
             for i in range(0, self.nHeats):
-                bR = self.nHeats - 1;
+                lo = (i / self.nCars) * self.nCars
+                hi = lo + self.nCars
+                bR = hi - 1;
                 bRt = 10000;
 
                 k = 0;
-                for j in range(0, self.nHeats):
+                for j in range(lo, hi):
                     if nU[j]:
                         k = self.rateRace(i, j)
                         if k < (bRt - 0.000001):
                             bRt = k
                             bR = j
 
-                for l in range(0,self.nLanes):
-                    car = self.pn[(self.nLanes * bR) + l]
-                    self.pn2[(self.nLanes * i) + l] = car;
+                heat = self.pn[(self.nLanes * bR):(self.nLanes * (bR+1))]
+                self.pn2[(self.nLanes * i):(self.nLanes * (i+1))] = heat
+                self.sumSq += self.rise(bR)
+                for car in heat:
                     self.sums[car - 1] += 1
+                self.order[i] = bR
                 nU[bR] = 0
+                yield i
+
+    ################################################################################
+    ##
+    ##  iterOrderNumpy
+    ##  Same greedy ordering as iterOrder, but rates every unused heat for
+    ##  slot i with one set of array operations instead of calling rateRace
+    ##  per heat.
+    ##
+    ################################################################################
+    def iterOrderNumpy(self):
+        nL = self.nLanes
+        pn = numpy.array(self.pn[:self.nHeats * nL]).reshape(self.nHeats, nL)
+        dups = numpy.array([self.dupPairs(j) for j in range(0, self.nHeats)])
+        sums = numpy.zeros(self.nCars + 1, dtype=numpy.int64)
+        self.sumSq = 0
+        self.order = makeArray(self.nHeats, code=heatCode(self.nHeats))
+        prev = None
+
+        for i in range(0, self.nHeats):
+            if (i % self.nCars) == 0:
+                lo = i
+                hi = lo + self.nCars
+                left = numpy.arange(lo, hi)
+            cand = pn[left]
+            rating = numpy.zeros(len(left))
+
+            if self.W1:
+                sq = self.sumSq + dups[left] + (2 * sums[cand] + 1).sum(axis=1)
+                n = float((i + 1) * nL)
+                rating += self.W1 * ((sq - (n * n) / self.nCars) / n)
+
+            if i > 0:
+                if self.W2:
+                    seen = numpy.bincount(prev, minlength=self.nCars + 1)
+                    rating += self.W2 * seen[cand].sum(axis=1)
+                if self.W3:
+                    rating += self.W3 * (cand == prev).sum(axis=1)
+
+            k = firstBest(rating)
+            if k is None:
+                k = numpy.flatnonzero(left == hi - 1)
+                k = k[0] if len(k) else None
+
+            if k is None:
+                prev = pn[hi - 1]
+                self.order[i] = hi - 1
+            else:
+                prev = cand[k]
+                self.order[i] = left[k]
+                left = numpy.delete(left, k)
+
+            for l in range(0, nL):
+                car = int(prev[l])
+                self.pn2[(nL * i) + l] = car
+                self.sumSq += 2 * self.sums[car - 1] + 1
+                self.sums[car - 1] += 1
+                sums[car] += 1
+            yield i
+
+    ################################################################################
+    ##
+    ##  makeMasks
+    ##  Precomputes, for every heat in pn:
+    ##
+    ##  bits  -- car membership bitsets, bit c set for car c. A car that
+    ##           appears d times is in the first d of them, so there's only
+    ##           more than one when a heat repeats a car.
+    ##  lanes -- the heat's cars packed into one integer, a field of width
+    ##           bits per lane with the top bit of each field left clear
+    ##  pick  -- an itemgetter for the heat's cars in sums
+    ##
+    ##  order[i] records the heat placed in slot i, so the checks can find
+    ##  the previous heat's masks.
+    ##
+    ################################################################################
+    def makeMasks(self):
+        nL = self.nLanes
+        width = self.nCars.bit_length() + 1
+        field = (1 << (width - 1)) - 1
+        self.low  = 0
+        self.high = 0
+        for l in range(0, nL):
+            self.low  |= field << (l * width)
+            self.high |= (field + 1) << (l * width)
+
+        self.order = makeArray(self.nHeats, code=heatCode(self.nHeats))
+        self.bits  = []
+        self.lanes = []
+        self.pick  = []
+        for j in range(0, self.nHeats):
+            heat = self.pn[nL * j:nL * (j+1)]
+            layers = []
+            packed = 0
+            for l in range(0, nL):
+                car = heat[l]
+                packed |= car << (l * width)
+                bit = 1 << car
+                for k in range(0, len(layers)):
+                    if not (layers[k] & bit):
+                        layers[k] |= bit
+                        break
+                else:
+                    layers.append(bit)
+            self.bits.append(tuple(layers))
+            self.lanes.append(packed)
+            self.pick.append(operator.itemgetter(*[car - 1 for car in heat]))
+
+    def rise(self, j):
+        # Growth in the sum of squared race counts from running heat j
+        return self.dups[j] + self.nLanes + 2 * sum(self.pick[j](self.sums))
+
+    def dupPairs(self, j):
+        # Sum of d*(d-1) over cars appearing d times in heat j.  Always zero
+        # for a proper schedule, but keeps check1 exact if a car repeats.
+        heat = self.pn[self.nLanes * j:self.nLanes * (j+1)]
+        return sum([heat.count(car) - 1 for car in heat])
 
     def getParms(self):
         if self.nCars < self.nLanes:
             self.nLanes = self.nCars
 
-        for (lo, hi, T, tg) in PPN_PARMS[self.nLanes]:
-            if lo <= self.nCars <= hi:
-                return (T, tg)
-
-        raise PpnException("Can't find parameters for nLanes=%d, nCars=%d")%(self.nLanes, self.nCars)
+        parms = parmTable().lookup(self.nLanes, self.nCars)
+        if parms is None and self.nCars > parmTable().maxCars:
+            # Past the end of the tables, search for the generators instead
+            parms = ppnsearch.findParms(self.nLanes, self.nCars, self.nRounds)
+        if parms is None:
+            raise PpnException("Can't find parameters for nLanes=%d, nCars=%d"%(self.nLanes, self.nCars))
+        return parms
 
     ################################################################################
     ##
@@ -378,26 +921,14 @@ class Ppn(object):
     ##
     ################################################################################
     def check1(self, i, j):
-        rC = makeArray(self.nCars)
+        # The deviation is sum((rC[l] - tgt)**2) over all cars.  Since the
+        # race counts always total (i + 1) * nLanes, that expands to
+        # sum(rC[l]**2) - ((i + 1) * nLanes)**2 / nCars, and adding heat j
+        # only changes the squares of its own cars.
+        sq = self.sumSq + self.rise(j)
 
-        for l in range(0, self.nCars):
-            rC[l] = self.sums[l]
-        
-        lo = self.nLanes * j
-        hi = self.nLanes * (j+1)
-        for m in range(lo, hi):
-            car = self.pn[m]
-            rC[car - 1] += 1
-
-        dev = float(0)
-        i = float(i)
-        j = float(j)
-        nL = float(self.nLanes)
-        nC = float(self.nCars)
-        tgt = ((i + 1) * nL) / nC;
-        for l in range(0, self.nCars):
-            dev += (rC[l] - tgt) * (rC[l] - tgt)
-        dev = dev / ((i + 1) * self.nLanes)
+        n = float((i + 1) * self.nLanes)
+        dev = (sq - (n * n) / self.nCars) / n
         return dev
 
     ################################################################################
@@ -407,12 +938,14 @@ class Ppn(object):
     ##
     ################################################################################
     def check2(self, i, j):
-        cM = 0;
-
-        for l in range(0, self.nLanes):
-            for m in range(0,self.nLanes):
-                if (self.pn[((j * self.nLanes) + l)] == self.pn2[(((i - 1) * self.nLanes) + m)]):
-                    cM += 1
+        # Counts lane pairs holding the same car, i.e. the sum over cars of
+        # their counts in the two heats. Without repeated cars that's the
+        # size of the intersection of the membership sets.
+        prev = self.bits[self.order[i - 1]]
+        cM = 0
+        for a in self.bits[j]:
+            for b in prev:
+                cM += popcount(a & b)
 
         return cM
 
@@ -423,11 +956,11 @@ class Ppn(object):
     ##
     ################################################################################
     def check3(self, i, j):
-        lM = 0
-
-        for l in range(0, self.nLanes):
-            if (self.pn[((j * self.nLanes) + l)] == self.pn2[(((i - 1) * self.nLanes) + l)]):
-                lM += 1
+        # Fields of the XOR are zero where the lanes match. Adding low to
+        # the lower bits of each field carries into its top bit unless the
+        # field is zero, without spilling into the next field.
+        x = self.lanes[j] ^ self.lanes[self.order[i - 1]]
+        lM = self.nLanes - popcount((((x & self.low) + self.low) | x) & self.high)
 
         return lM
 
@@ -457,14 +990,8 @@ class Ppn(object):
     ##
     ################################################################################
     def makeHeats(self):
-        lo = 0
-        heats = []
-
-        while len(self.pn[lo:]) > 1:
-            heats.append(self.pn2[lo:lo+self.nLanes])
-            lo += self.nLanes
-
-        return heats
+        return [HeatView(self.pn2, self.nLanes * i, self.nLanes)
+                for i in range(0, self.nHeats)]
 
 ##############################################################################
 ##
@@ -569,5 +1096,206 @@ if __name__ == '__main__':
                 (6,17,M,M,M) : [[1,2,4,6,9,15],[2,3,5,7,10,16],[3,4,6,8,11,17],[10,11,13,15,1,7],[9,10,12,14,17,6],[8,9,11,13,16,5],[7,8,10,12,15,4],[17,1,3,5,8,14],[16,17,2,4,7,13],[15,16,1,3,6,12],[14,15,17,2,5,11],[4,5,7,9,12,1],[11,12,14,16,2,8],[12,13,15,17,3,9],[5,6,8,10,13,2],[6,7,9,11,14,3],[13,14,16,1,4,10]],
             }
             self.check(tests)
-            
+
+        def test_08(self):
+            # check1 must agree with the full deviation over every car
+            for (l,c) in ((2,9),(4,13),(6,17),(6,40)):
+                ppn    = Ppn(l, c)
+                ppn.W1 = Weight.MEDIUM
+                ppn.generate()
+                ppn.sums  = makeArray(c)
+                ppn.sumSq = 0
+                for i in range(0, ppn.nHeats):
+                    for j in range(0, ppn.nHeats):
+                        rC = ppn.sums[:c]
+                        for car in ppn.pn[l*j:l*(j+1)]:
+                            rC[car - 1] += 1
+                        tgt = ((i + 1) * l) / float(c)
+                        want = sum([(x - tgt) * (x - tgt) for x in rC]) / ((i + 1) * l)
+                        self.assertAlmostEqual(want, ppn.check1(i, j))
+                    for car in ppn.pn2[l*i:l*(i+1)]:
+                        ppn.sumSq += 2 * ppn.sums[car - 1] + 1
+                        ppn.sums[car - 1] += 1
+
+        def test_09(self):
+            # The NumPy ordering must match the pure Python ordering
+            if not numpy:
+                return
+            W = (Weight.ZERO, Weight.LIGHT, Weight.MEDIUM, Weight.HEAVY)
+            for (l,c) in ((2,9),(3,13),(4,24),(5,36),(6,17),(6,64)):
+                for w in ((W[3],0,0),(0,W[3],0),(0,0,W[3]),(W[1],W[2],W[3]),(W[2],W[2],W[2])):
+                    heats = []
+                    for useNumpy in (False, True):
+                        ppn = Ppn(l, c)
+                        (ppn.W1, ppn.W2, ppn.W3) = w
+                        ppn.useNumpy = useNumpy
+                        heats.append(ppn.generate())
+                    self.assertEqual(heats[0], heats[1], "\ntest=%s"%((l,c)+w,))
+
+        def test_10(self):
+            # The compiled table must agree with PPN_PARMS, also once saved
+            (fd, fname) = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                parmTable().save(fname)
+                tables = (parmTable(), PpnTable.load(fname))
+                for nLanes in range(2, 7):
+                    for (lo, hi, T, tg) in PPN_PARMS[nLanes]:
+                        for nCars in range(lo, hi + 1):
+                            for table in tables:
+                                self.assertEqual((T, tg), table.lookup(nLanes, nCars))
+                    for table in tables:
+                        self.assertEqual(None, table.lookup(nLanes, 1))
+                        self.assertEqual(None, table.lookup(nLanes, 201))
+
+                # Slices of the mapped arrays behave like tuple slices
+                values = tuple(tables[1].values[:])
+                for sl in (slice(3, 9), slice(9, 3, -1), slice(None, None, -2),
+                           slice(-5, None), slice(2, 40, 3), slice(6, 2), slice(-1, -8, -3)):
+                    self.assertEqual(values[sl], tables[1].values[sl])
+                self.assertEqual(values[-1], tables[1].values[-1])
+            finally:
+                os.unlink(fname)
+
+        def test_11(self):
+            # Streamed heats must match the generated schedule
+            for (l,c) in ((2,9),(5,13),(6,40)):
+                for useNumpy in (False, True):
+                    for w in ((0,0,0),(Weight.LIGHT,Weight.MEDIUM,Weight.HEAVY)):
+                        ppn = Ppn(l, c)
+                        (ppn.W1, ppn.W2, ppn.W3) = w
+                        ppn.useNumpy = useNumpy
+                        want = ppn.generate()
+                        ppn = Ppn(l, c)
+                        (ppn.W1, ppn.W2, ppn.W3) = w
+                        ppn.useNumpy = useNumpy
+                        self.assertEqual(want, list(ppn.iterHeats()))
+
+        def test_12(self):
+            # Every round runs each car once in every lane. Rounds are
+            # distinct as far as the tables have generator sets, and past
+            # those repeat the earlier rounds.
+            for (l,c,r) in ((2,5,4),(3,13,3),(2,9,8),(5,13,2),(4,30,2),
+                    (4,24,2),(6,8,2),(6,17,3),(6,50,4)):
+                for useNumpy in (False, True):
+                    ppn = Ppn(l, c)
+                    ppn.nRounds = r
+                    (ppn.W1, ppn.W2, ppn.W3) = (Weight.MEDIUM,)*3
+                    ppn.useNumpy = useNumpy
+                    heats = ppn.generate()
+                    self.assertEqual(len(heats), c * r)
+                    rounds = [sorted([tuple(heat) for heat in heats[rnd*c:(rnd+1)*c]])
+                            for rnd in range(0, r)]
+                    for rnd in range(0, r):
+                        for lane in range(0, l):
+                            cars = [heat[lane] for heat in rounds[rnd]]
+                            self.assertEqual(sorted(cars), range(1, c+1))
+                    d = distinctRounds(l, c)
+                    self.assertEqual(len(set([tuple(rnd) for rnd in rounds])), min(r, d))
+                    for rnd in range(d, r):
+                        self.assertEqual(rounds[rnd], rounds[rnd % d])
+            self.assertEqual(1, distinctRounds(6, 8))
+            self.assertEqual(None, distinctRounds(4, 240))
+
+        def test_13(self):
+            # Sizes past the tables get searched generators
+            for (l,c,r) in ((2,201,2),(4,240,1),(6,333,2)):
+                ppn = Ppn(l, c)
+                ppn.nRounds = r
+                heats = ppn.generate()
+                self.assertEqual(len(heats), c * r)
+                for lane in range(0, l):
+                    cars = [heat[lane] for heat in heats]
+                    self.assertEqual(sorted(cars), sorted(range(1, c+1) * r))
+
+        def test_14(self):
+            # Optimizing keeps each round's heats and never makes it worse
+            ppn = Ppn(5, 9)
+            ppn.nRounds = 2
+            (ppn.W1, ppn.W2, ppn.W3) = (Weight.HEAVY, Weight.LIGHT, Weight.MEDIUM)
+            want = ppn.generate()
+            ppn.optimize = 0.2
+            got = ppn.generate()
+            (before, after) = ppn.objective
+            self.assertTrue(after <= before)
+            for r in (0, 1):
+                self.assertEqual(sorted(want[r*9:(r+1)*9]), sorted(got[r*9:(r+1)*9]))
+
+        def test_15(self):
+            # Heats are views into pn2, not copies of it
+            ppn = Ppn(4, 13)
+            (ppn.W1, ppn.W2, ppn.W3) = (Weight.MEDIUM,)*3
+            heats = ppn.generate()
+            self.assertEqual(type(ppn.pn2), array.array)
+            self.assertEqual(heats[2], ppn.pn2[8:12].tolist())
+            self.assertEqual(heats[2][-1], heats[2][3])
+            self.assertEqual(heats[2][1:3], list(heats[2])[1:3])
+            ppn.pn2[9] = 99
+            self.assertEqual(heats[2][1], 99)
+            self.assertRaises(IndexError, lambda: heats[2][4])
+            self.assertTrue(heats[0] < heats[0].tolist() + [1])
+            self.assertNotEqual(heats[0], None)
+
+        def test_16(self):
+            # The bitset checks must agree with comparing lane by lane, also
+            # for heats that repeat a car
+            for (l,c) in ((2,9),(4,13),(6,17),(6,130)):
+                ppn = Ppn(l, c)
+                (ppn.W1, ppn.W2, ppn.W3) = (Weight.LIGHT, Weight.MEDIUM, Weight.HEAVY)
+                ppn.generate()
+                ppn.pn[0:l] = array.array(ppn.code, [c] * (l - 1) + [1])
+                ppn.pn[l:2*l] = array.array(ppn.code, [c, 2] * (l / 2) + [c] * (l % 2))
+                ppn.makeMasks()
+                for k in range(0, ppn.nHeats):
+                    ppn.order[0] = k
+                    prev = ppn.pn[l*k:l*(k+1)].tolist()
+                    for j in range(0, ppn.nHeats):
+                        heat = ppn.pn[l*j:l*(j+1)].tolist()
+                        self.assertEqual(sum([prev.count(car) for car in heat]), ppn.check2(1, j))
+                        self.assertEqual(sum([prev[m] == heat[m] for m in range(0, l)]), ppn.check3(1, j))
+
+        def test_17(self):
+            # The implicit schedule must give the generated heats
+            for (l,c,r) in ((2,9,1),(6,4,1),(4,13,2),(3,13,3),(6,40,1),(3,201,2)):
+                for w in ((0,0,0),(Weight.LIGHT,Weight.MEDIUM,Weight.HEAVY)):
+                    for (useNumpy, optimize) in ((False, 0), (True, 0), (False, 0.1)):
+                        ppn = Ppn(l, c)
+                        ppn.nRounds = r
+                        (ppn.W1, ppn.W2, ppn.W3) = w
+                        ppn.useNumpy = useNumpy
+                        ppn.optimize = optimize
+                        want = ppn.generate()
+                        sched = ppn.makeSchedule()
+                        self.assertEqual(want, list(sched))
+                        self.assertEqual(want[-1], sched[-1])
+                        self.assertEqual(want[1:3], sched[1:3])
+                        self.assertEqual(want[2][1], sched.car(2, 1))
+                        self.assertRaises(IndexError, lambda: sched[len(want)])
+
+        def test_18(self):
+            # Near ties chain the way the sequential scan does, which is
+            # not always the first heat within eps of the minimum
+            if not numpy:
+                return
+            eps = 0.000001
+            for rating in ([1.0, 1.0 - 0.7*eps, 1.0 - 1.4*eps],
+                           [5.0, 3.0, 3.0 + 0.5*eps, 3.0 - 0.5*eps, 3.0 - 1.2*eps, 2.0 + eps],
+                           [10000, 10000], [7.0]):
+                (bR, bRt) = (None, 10000)
+                for j in range(0, len(rating)):
+                    if rating[j] < (bRt - eps):
+                        (bR, bRt) = (j, rating[j])
+                self.assertEqual(bR, firstBest(numpy.array(rating)))
+
+        def test_19(self):
+            # Heats that repeat, as two rounds from the same generators do,
+            # still leave the order a permutation once optimized
+            ppn = Ppn(2, 2)
+            ppn.nRounds = 2
+            (ppn.W1, ppn.W2, ppn.W3) = (Weight.LIGHT, Weight.MEDIUM, Weight.HEAVY)
+            ppn.optimize = 0.05
+            want = ppn.generate()
+            self.assertEqual(sorted(ppn.order[:ppn.nHeats]), range(0, ppn.nHeats))
+            self.assertEqual(want, list(ppn.makeSchedule()))
+
     unittest.main()
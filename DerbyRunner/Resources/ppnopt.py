@@ -0,0 +1,286 @@
+#! /usr/bin/env python
+################################################################################
+##
+##  ppnopt.py
+##
+##  Improves the heat order left by the greedy pass in Ppn.orderRaces.
+##  The objective is the sum, over every slot, of the rating the greedy
+##  pass uses (W1 * check1 + W2 * check2 + W3 * check3). Moves swap two
+##  heats of the same round. Only the slot pairs around the two heats see
+##  different neighbours, and the race counts between them all shift by
+##  the same heat difference, so the change in objective is worked out
+##  from the appearances of the swapped cars rather than the whole
+##  schedule.
+##
+################################################################################
+import bisect
+import math
+import random
+import time
+import unittest
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+# Worker processes for the restarts of run. None uses one per CPU, 1 runs
+# them in this process.
+PROCESSES = None
+
+################################################################################
+##
+##  Optimizer
+##
+################################################################################
+class Optimizer(object):
+    def __init__(self, heats, nCars, W1=0, W2=0, W3=0, block=None):
+        self.heats  = [tuple(heat) for heat in heats]
+        self.nCars  = nCars
+        self.nLanes = len(self.heats[0])
+        self.W1 = W1
+        self.W2 = W2
+        self.W3 = W3
+
+        # Heats are only swapped within blocks of this many slots, one
+        # block per round
+        self.block = block or len(self.heats)
+
+        # harm[k] is the sum of 1 / ((i + 1) * nLanes) for i < k
+        self.harm = [0.0]
+        for i in range(0, len(self.heats)):
+            self.harm.append(self.harm[-1] + 1.0 / ((i + 1) * self.nLanes))
+
+        self.before = self.objective(self.heats)
+        self.after  = self.before
+
+    ############################################################################
+    ##  Full evaluation, used for the before and after figures
+    ############################################################################
+    def objective(self, heats):
+        nL = self.nLanes
+        sums = [0] * (self.nCars + 1)
+        sq = 0
+        total = 0.0
+        for i in range(0, len(heats)):
+            for car in heats[i]:
+                sq += 2 * sums[car] + 1
+                sums[car] += 1
+            if self.W1:
+                n = float((i + 1) * nL)
+                total += self.W1 * ((sq - (n * n) / self.nCars) / n)
+            if i > 0:
+                total += self.pair(heats[i-1], heats[i])
+        return total
+
+    def pair(self, prev, heat):
+        rating = 0
+        if self.W2:
+            rating += self.W2 * sum([prev.count(car) for car in heat])
+        if self.W3:
+            rating += self.W3 * sum([prev[l] == heat[l] for l in range(0, self.nLanes)])
+        return rating
+
+    ############################################################################
+    ##  Change in objective from swapping the heats in slots a < b.
+    ##  where[car] is the sorted list of slots the car races in. Between a
+    ##  and b every race count moves by e = (count in y) - (count in x),
+    ##  which changes the sum of squares behind slot k by
+    ##  sum(2 * e * count + e * e). Weighted by 1/((k + 1) * nLanes) and
+    ##  summed over k that only needs the slots each car races in, through
+    ##  the running totals in self.harm.
+    ############################################################################
+    def delta(self, heats, where, a, b):
+        x = heats[a]
+        y = heats[b]
+        change = 0.0
+
+        if self.W1:
+            harm = self.harm
+            e = {}
+            for car in y:
+                e[car] = e.get(car, 0) + 1
+            for car in x:
+                e[car] = e.get(car, 0) - 1
+            span = harm[b] - harm[a]
+            sq = 0.0
+            for (car, ec) in e.iteritems():
+                if not ec:
+                    continue
+                slots = where[car]
+                lo = bisect.bisect_left(slots, a)
+                hi = bisect.bisect_left(slots, b)
+                weight = lo * span
+                for p in slots[lo:hi]:
+                    weight += harm[b] - harm[p]
+                sq += (ec * ec * span) + (2 * ec * weight)
+            change += self.W1 * sq
+
+        if self.W2 or self.W3:
+            def at(i):
+                if i == a:
+                    return y
+                if i == b:
+                    return x
+                return heats[i]
+            for i in set((a - 1, a, b - 1, b)):
+                if 0 <= i < len(heats) - 1:
+                    change += self.pair(at(i), at(i+1)) - self.pair(heats[i], heats[i+1])
+        return change
+
+    def swap(self, heats, where, a, b):
+        (x, y) = (heats[a], heats[b])
+        for (heat, old, new) in ((x, a, b), (y, b, a)):
+            for car in heat:
+                slots = where[car]
+                del slots[bisect.bisect_left(slots, old)]
+                bisect.insort(slots, new)
+        (heats[a], heats[b]) = (y, x)
+
+    def move(self, rng):
+        a = rng.randrange(0, len(self.heats))
+        lo = (a / self.block) * self.block
+        hi = min(lo + self.block, len(self.heats))
+        b = rng.randrange(lo, hi - 1)
+        if b >= a:
+            b += 1
+        return (min(a, b), max(a, b))
+
+    ############################################################################
+    ##  Simulated annealing from the starting order for budget seconds.
+    ##  Returns (objective, heats) for the best order seen.
+    ############################################################################
+    def anneal(self, budget, seed=0):
+        rng = random.Random(seed)
+        heats = list(self.heats)
+        where = [[] for car in range(0, self.nCars + 1)]
+        for i in range(0, len(heats)):
+            for car in heats[i]:
+                where[car].append(i)
+
+        if min(self.block, len(heats)) < 2:
+            return (self.before, heats)
+
+        # Start hot enough to take a typical uphill move
+        sample = [abs(self.delta(heats, where, *self.move(rng))) for n in range(0, 100)]
+        hot = (sum(sample) / len(sample)) or 1.0
+        cold = hot * 0.001
+
+        current = self.before
+        best = (current, list(heats))
+        start = time.time()
+        temp = hot
+        n = 0
+        while True:
+            n += 1
+            if (n % 256) == 0:
+                done = (time.time() - start) / budget
+                if done >= 1:
+                    break
+                temp = hot * math.pow(cold / hot, done)
+
+            (a, b) = self.move(rng)
+            change = self.delta(heats, where, a, b)
+            if change < 0 or rng.random() < math.exp(-change / temp):
+                self.swap(heats, where, a, b)
+                current += change
+                if current < (best[0] - 0.000001):
+                    best = (current, list(heats))
+
+        # Recompute the total so rounding in the running sum can't stick
+        return (self.objective(best[1]), best[1])
+
+    ############################################################################
+    ##  Runs restarts with different seeds, in worker processes when it can,
+    ##  and keeps the best order. Returns the heats as lists.
+    ############################################################################
+    def run(self, budget, restarts=1, processes=None):
+        if processes is None:
+            processes = PROCESSES
+        tasks = [(self, budget, seed) for seed in range(0, restarts)]
+
+        results = None
+        if restarts > 1 and processes != 1 and multiprocessing:
+            try:
+                pool = multiprocessing.Pool(processes)
+            except Exception:
+                pool = None
+            if pool:
+                try:
+                    results = pool.map(_anneal, tasks)
+                finally:
+                    pool.terminate()
+        if results is None:
+            tasks = [(self, float(budget) / restarts, seed) for seed in range(0, restarts)]
+            results = map(_anneal, tasks)
+
+        (after, heats) = min(results, key=lambda result: result[0])
+        if after < self.after:
+            self.after = after
+            self.heats = heats
+        return [list(heat) for heat in self.heats]
+
+def _anneal(args):
+    (opt, budget, seed) = args
+    return opt.anneal(budget, seed)
+
+################################################################################
+##
+##  TC_Optimizer
+##
+################################################################################
+class TC_Optimizer(unittest.TestCase):
+    def greedy(self, nLanes, nCars, W, nRounds=1):
+        import ppngen
+        ppn = ppngen.Ppn(nLanes, nCars)
+        ppn.nRounds = nRounds
+        (ppn.W1, ppn.W2, ppn.W3) = W
+        return ppn.generate()
+
+    def test_objective(self):
+        # The objective is the greedy pass's best rating summed over slots
+        import ppngen
+        best = {}
+        class Recorder(ppngen.Ppn):
+            def rateRace(self, i, j):
+                rating = ppngen.Ppn.rateRace(self, i, j)
+                best[i] = min(best.get(i, rating), rating)
+                return rating
+        ppn = Recorder(6, 17)
+        (ppn.W1, ppn.W2, ppn.W3) = (1, 10, 100)
+        opt = Optimizer(ppn.generate(), 17, 1, 10, 100)
+        self.assertAlmostEqual(sum(best.values()), opt.before)
+
+    def test_delta(self):
+        heats = self.greedy(5, 23, (10, 10, 10))
+        opt = Optimizer(heats, 23, 10, 10, 10)
+        heats = list(opt.heats)
+        where = [[] for car in range(0, 24)]
+        for i in range(0, len(heats)):
+            for car in heats[i]:
+                where[car].append(i)
+        rng = random.Random(1)
+        total = opt.before
+        for n in range(0, 200):
+            (a, b) = opt.move(rng)
+            total += opt.delta(heats, where, a, b)
+            opt.swap(heats, where, a, b)
+            self.assertAlmostEqual(total, opt.objective(heats))
+
+    def test_run(self):
+        heats = self.greedy(4, 30, (1, 10, 100), nRounds=2)
+        for processes in (1, None):
+            opt = Optimizer(heats, 30, 1, 10, 100, block=30)
+            got = opt.run(0.2, restarts=2, processes=processes)
+            self.assertTrue(opt.after <= opt.before)
+            self.assertAlmostEqual(opt.after, opt.objective(got))
+            for r in (0, 1):
+                self.assertEqual(sorted(heats[r*30:(r+1)*30]), sorted(got[r*30:(r+1)*30]))
+
+##############################################################################
+##
+##  main
+##
+##############################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,350 @@
+#! /usr/bin/env python
+################################################################################
+##
+##  ppnsearch.py
+##
+##  Finds generator vectors for sizes the Young and Pope tables in ppngen
+##  don't cover. A round of heats is the cyclic schedule where heat c puts
+##  car c + m[l] in lane l, for marks 0 = m[0] < m[1] < ... < m[nLanes-1]
+##  taken mod nCars. Every such round runs each car once in every lane.
+##  The marks are chosen so that all differences m[a] - m[b] are distinct
+##  mod nCars and none is nCars/2, which means two cars never meet more
+##  than once in a round. Later rounds also avoid the differences of the
+##  earlier ones, so pairs don't meet again until that's unavoidable.
+##
+##  The generators for a round are the gaps between its marks, the same
+##  form as the tg entries in PPN_PARMS.
+##
+##  A search can take seconds, so a page runs it with Search on a thread
+##  of its own. Searches share one pool of worker processes.
+##
+################################################################################
+import os
+import os.path
+import sys
+import threading
+import time
+import unittest
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+# Seconds allowed for one search
+BUDGET = 5.0
+
+# Worker processes for a search. None uses one per CPU, 1 searches in
+# this process.
+PROCESSES = None
+
+# Optional dict-like store (e.g. a derbydata.Database) that keeps results
+# across runs, so each size is only searched once.
+STORE = None
+
+# Each search task fixes the first generator to one of these values
+TASKS = 32
+
+# Seconds past the deadline to wait for tasks to return what they found
+GRACE = 0.5
+
+_found = {}
+_lock  = threading.Lock()
+_pool  = None
+
+################################################################################
+##
+##  SearchTimeout
+##
+################################################################################
+class SearchTimeout(Exception):
+    pass
+
+################################################################################
+##
+##  ruler
+##  Depth first search for one round of marks whose differences, in both
+##  directions, avoid the set used. Candidates are tried smallest first so
+##  the generators come out small like the ones in the tables.
+##
+################################################################################
+def ruler(nLanes, nCars, used, first=None, deadline=None):
+    def extend(marks, taken):
+        if len(marks) == nLanes:
+            return marks
+        if deadline and time.time() > deadline:
+            raise SearchTimeout()
+
+        if len(marks) == 1 and first:
+            candidates = [first]
+        else:
+            candidates = range(marks[-1] + 1, nCars - (nLanes - len(marks)) + 1)
+
+        for m in candidates:
+            new = set()
+            for x in marks:
+                for d in (m - x, nCars - (m - x)):
+                    if d in taken or d in new:
+                        break
+                    new.add(d)
+                else:
+                    continue
+                break
+            else:
+                found = extend(marks + [m], taken | new)
+                if found:
+                    return found
+        return None
+
+    return extend([0], set(used))
+
+################################################################################
+##
+##  searchRounds
+##  Finds up to nRounds rounds of marks, each avoiding the differences of
+##  the rounds before it. Returns the list of rounds found before running
+##  out of rounds, options or time.
+##
+################################################################################
+def searchRounds(nLanes, nCars, nRounds, first=None, deadline=None):
+    used = set()
+    rounds = []
+    try:
+        for r in range(0, nRounds):
+            if r > 0:
+                first = None
+            marks = ruler(nLanes, nCars, used, first, deadline)
+            if marks is None:
+                break
+            rounds.append(tuple(marks))
+            for a in marks:
+                for b in marks:
+                    if a != b:
+                        used.add((a - b) % nCars)
+    except SearchTimeout:
+        pass
+    return rounds
+
+def _searchTask(args):
+    (n, task) = args
+    return (n, searchRounds(*task))
+
+# The pool of worker processes, made on first use and kept for later
+# searches. None when processes is 1 or there can't be one.
+def _getPool(processes):
+    global _pool
+    if processes == 1 or not multiprocessing:
+        return None
+    if _pool is None:
+        try:
+            _pool = multiprocessing.Pool(processes)
+        except Exception:
+            return None
+    return _pool
+
+# Yields (task number, rounds) as the tasks finish. Tasks stop themselves
+# at the deadline with what they have, so a slow one doesn't hide the
+# ones after it.
+def _runTasks(tasks, deadline, processes):
+    pool = _getPool(processes)
+    if pool is not None:
+        results = pool.imap_unordered(_searchTask, list(enumerate(tasks)))
+        for n in range(0, len(tasks)):
+            timeout = max(0, deadline - time.time()) + GRACE
+            try:
+                yield results.next(timeout)
+            except multiprocessing.TimeoutError:
+                return
+        return
+
+    for (n, task) in enumerate(tasks):
+        if time.time() > deadline:
+            return
+        yield _searchTask((n, task))
+
+################################################################################
+##
+##  findParms
+##  Returns (T, tg) in the form of a PPN_PARMS entry, with one T value per
+##  round found (T itself isn't used by Ppn beyond its length), or None if
+##  no round could be found within the budget.
+##
+################################################################################
+def findParms(nLanes, nCars, nRounds=1, budget=None, processes=None):
+    if budget is None:
+        budget = BUDGET
+    if processes is None:
+        processes = PROCESSES
+
+    parms = known(nLanes, nCars, nRounds)
+    if parms is not None:
+        return parms
+
+    deadline = time.time() + budget
+    tasks = [(nLanes, nCars, nRounds, first, deadline)
+            for first in range(1, min(nCars, TASKS + 1))]
+
+    # The smallest first generator that gives the most rounds wins,
+    # regardless of which worker finishes first, so a complete answer is
+    # only taken once every task before it is in.
+    found = {}
+    for (n, rounds) in _runTasks(tasks, deadline, processes):
+        found[n] = rounds
+        full = [k for k in found if len(found[k]) == nRounds]
+        if full and len([k for k in found if k < min(full)]) == min(full):
+            break
+    best = []
+    for n in sorted(found):
+        if len(found[n]) > len(best):
+            best = found[n]
+    if not best:
+        return None
+
+    tg = []
+    for marks in best:
+        tg.extend([marks[k] - marks[k-1] for k in range(1, nLanes)])
+    parms = ((1,) * len(best), tuple(tg))
+
+    # A partial answer may just have run out of time, so it's only kept as
+    # the answer for the rounds it has
+    if known(nLanes, nCars, len(best)) is None:
+        keep(nLanes, nCars, len(best), parms)
+    return parms
+
+# The (T, tg) found earlier for a size, or None
+def known(nLanes, nCars, nRounds):
+    key = '%d,%d,%d'%(nLanes, nCars, nRounds)
+    parms = _found.get(key)
+    if parms is None and STORE is not None:
+        _lock.acquire()
+        try:
+            try:
+                (T, tg) = STORE[key].split(';')
+            except KeyError:
+                return None
+        finally:
+            _lock.release()
+        parms = (tuple([int(x) for x in T.split(',')]),
+                 tuple([int(x) for x in tg.split(',')]))
+        _found[key] = parms
+    return parms
+
+def keep(nLanes, nCars, nRounds, parms):
+    key = '%d,%d,%d'%(nLanes, nCars, nRounds)
+    _found[key] = parms
+    if STORE is not None:
+        _lock.acquire()
+        try:
+            STORE[key] = '%s;%s'%(','.join([str(x) for x in parms[0]]),
+                                  ','.join([str(x) for x in parms[1]]))
+        finally:
+            _lock.release()
+
+################################################################################
+##
+##  Search
+##
+##  findParms on a thread of its own, for a page to start and then poll
+##  until done. parms is what findParms returned.
+##
+################################################################################
+class Search(object):
+    def __init__(self, nLanes, nCars, nRounds=1):
+        self.args   = (nLanes, nCars, nRounds)
+        self.thread = None
+        self.parms  = None
+        self.done   = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='Search')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.parms = findParms(*self.args)
+        finally:
+            self.done = True
+
+################################################################################
+##
+##  TC_Search
+##
+################################################################################
+class TC_Search(unittest.TestCase):
+    def schedule(self, nLanes, nCars, tg):
+        heats = []
+        for r in range(0, len(tg) / (nLanes - 1)):
+            gens = tg[r*(nLanes-1):(r+1)*(nLanes-1)]
+            for c in range(0, nCars):
+                heat = [c]
+                for g in gens:
+                    heat.append((heat[-1] + g) % nCars)
+                heats.append(heat)
+        return heats
+
+    def check(self, nLanes, nCars, nRounds, processes):
+        (T, tg) = findParms(nLanes, nCars, nRounds, processes=processes)
+        self.assertEqual(len(T), nRounds)
+        heats = self.schedule(nLanes, nCars, tg)
+        for r in range(0, nRounds):
+            for lane in range(0, nLanes):
+                cars = [heat[lane] for heat in heats[r*nCars:(r+1)*nCars]]
+                self.assertEqual(sorted(cars), range(0, nCars))
+        met = set()
+        for heat in heats:
+            self.assertEqual(len(set(heat)), nLanes)
+            for a in heat:
+                for b in heat:
+                    if a < b:
+                        self.assertFalse((a, b) in met)
+                        met.add((a, b))
+
+    def test_serial(self):
+        for (nLanes, nCars, nRounds) in ((2,7,3),(3,13,2),(4,40,2),(6,250,1),(6,500,3)):
+            self.check(nLanes, nCars, nRounds, 1)
+
+    def test_pool(self):
+        for (nLanes, nCars, nRounds) in ((5,61,2),(6,1000,4)):
+            self.check(nLanes, nCars, nRounds, None)
+
+    def test_store(self):
+        global STORE
+        STORE = {}
+        try:
+            want = findParms(5, 333, 2, processes=1)
+            _found.clear()
+            self.assertTrue('5,333,2' in STORE)
+            self.assertEqual(want, findParms(5, 333, 2, budget=0))
+        finally:
+            STORE = None
+
+    def test_partial(self):
+        # Short of rounds, the ones found are kept for that many rounds only
+        (T, tg) = findParms(6, 211, 40, budget=0.2, processes=1)
+        self.assertTrue(0 < len(T) < 40)
+        self.assertEqual(known(6, 211, 40), None)
+        self.assertEqual(known(6, 211, len(T)), (T, tg))
+
+    def test_thread(self):
+        search = Search(4, 260, 2)
+        search.start()
+        search.thread.join()
+        self.assertTrue(search.done)
+        self.assertEqual(search.parms, findParms(4, 260, 2, budget=0))
+
+    def test_order(self):
+        # The pool gives the same answer as searching task by task
+        for (nLanes, nCars, nRounds) in ((4,209,3),(6,301,2)):
+            want = findParms(nLanes, nCars, nRounds, processes=1)
+            _found.clear()
+            self.assertEqual(want, findParms(nLanes, nCars, nRounds))
+            self.assertTrue(_getPool(None) is _getPool(None))
+
+##############################################################################
+##
+##  main
+##
+##############################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+################################################################################
+##
+##  standings.py
+##
+##  Race standings kept in rank order as results come in. Each result only
+##  moves its own entrant, so a change is applied as a point delta: the
+##  entrant is taken out of the sorted order and put back with bisect, and
+##  the rows between its old and new rank are the only ones that change.
+##
+################################################################################
+import bisect
+import random
+import unittest
+
+################################################################################
+##
+##  Standings
+##
+##  Entrants are ranked by points, most first, then in the order they were
+##  given. order holds (-points, seq, entrant) so plain tuple order is rank
+##  order and entrants themselves are never compared.
+##
+################################################################################
+class Standings(object):
+    def __init__(self, entrants):
+        self.points = {}
+        self.seq    = {}
+        self.order  = []
+        for entrant in entrants:
+            self.seq[entrant] = len(self.order)
+            self.points[entrant] = 0
+            self.order.append((0, self.seq[entrant], entrant))
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        for (neg, seq, entrant) in self.order:
+            yield entrant
+
+    # (rank, points, entrant) for every entrant, in rank order
+    def rows(self):
+        return [(rank, -neg, entrant) for (rank, (neg, seq, entrant)) in enumerate(self.order)]
+
+    def entry(self, entrant):
+        return (-self.points[entrant], self.seq[entrant], entrant)
+
+    def rank(self, entrant):
+        return bisect.bisect_left(self.order, self.entry(entrant))
+
+    ############################################################################
+    ##  Adds delta points to entrant and returns the (rank, points, entrant)
+    ##  rows that changed, which always includes entrant's own row
+    ############################################################################
+    def score(self, entrant, delta):
+        old = self.rank(entrant)
+        del self.order[old]
+        self.points[entrant] += delta
+        new = bisect.bisect_left(self.order, self.entry(entrant))
+        self.order.insert(new, self.entry(entrant))
+
+        (lo, hi) = (min(old, new), max(old, new))
+        return [(rank, -self.order[rank][0], self.order[rank][2]) for rank in range(lo, hi + 1)]
+
+################################################################################
+##
+##  TC_Standings
+##
+################################################################################
+class TC_Standings(unittest.TestCase):
+    def full(self, points, entrants):
+        # The ranking a full recount and sort would give
+        return sorted(entrants, key=lambda e: (-points[e], entrants.index(e)))
+
+    def test_score(self):
+        entrants = ['car%02d'%n for n in range(0, 30)]
+        std = Standings(entrants)
+        self.assertEqual(list(std), entrants)
+
+        rng = random.Random(1)
+        points = dict([(e, 0) for e in entrants])
+        for n in range(0, 500):
+            entrant = rng.choice(entrants)
+            delta = rng.randint(-3, 6)
+            before = list(std)
+            changed = std.score(entrant, delta)
+            points[entrant] += delta
+
+            after = self.full(points, entrants)
+            self.assertEqual(list(std), after)
+            self.assertTrue((std.rank(entrant), points[entrant], entrant) in changed)
+            for rank in range(0, len(after)):
+                if before[rank] != after[rank]:
+                    self.assertTrue((rank, points[after[rank]], after[rank]) in changed)
+            self.assertEqual(std.rows(), [(r, points[e], e) for (r, e) in enumerate(after)])
+
+    def test_unmoved(self):
+        std = Standings(['a', 'b', 'c'])
+        self.assertEqual(std.score('b', 0), [(1, 0, 'b')])
+        self.assertEqual(std.score('c', 5), [(0, 5, 'c'), (1, 0, 'a'), (2, 0, 'b')])
+        self.assertEqual(std.score('a', 1), [(1, 1, 'a')])
+
+##############################################################################
+##
+##  main
+##
+##############################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+################################################################################
+##
+##  cfgbench.py
+##
+##  Times Config.read from derby.py on a generated event, by default 10000
+##  vehicles and 50 races, from the derbydata.Database store the app keeps
+##  events in, or with --backend text from derby.cfg as DERBY_BACKEND=text
+##  keeps them. derby.py normally runs inside Titanium, so it is loaded
+##  here with small stand-ins for the Titanium, window and document globals
+##  that only cover what its module level code touches.
+##
+##  cfgbench.py
+##  cfgbench.py --vehicles 1000 --races 5 --repeat 10
+##  cfgbench.py --backend text
+##
+################################################################################
+import optparse
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESDIR = os.path.normpath(os.path.join(HERE, '..', 'DerbyRunner', 'Resources'))
+sys.path.insert(0, RESDIR)
+
+class API(object):
+    FATAL    = 1
+    CRITICAL = 2
+    ERROR    = 3
+    WARN     = 4
+    NOTICE   = 5
+    INFO     = 6
+    DEBUG    = 7
+
+    def log(self, level, msg):
+        pass
+
+    def addEventListener(self, event, callback):
+        pass
+
+class Filesystem(object):
+    def __init__(self, appdir):
+        self.appdir = appdir
+
+    def getResourcesDirectory(self):
+        return RESDIR
+
+    def getApplicationDataDirectory(self):
+        return self.appdir
+
+class Titanium(object):
+    EXIT = 'exit'
+
+    def __init__(self, appdir):
+        self.API = API()
+        self.Filesystem = Filesystem(appdir)
+
+# The timers never run, the log is written out by a flush at the end
+class Window(object):
+    def setTimeout(self, callback, ms):
+        pass
+
+def loadDerby(appdir):
+    env = {
+        '__name__' : 'derby',
+        'Titanium' : Titanium(appdir),
+        'window'   : Window(),
+        'document' : None,
+    }
+    execfile(os.path.join(RESDIR, 'derby.py'), env)
+    return env
+
+################################################################################
+##
+##  makeEvent
+##  Writes a config in the derby.cfg format with nVehicles vehicles, each
+##  entered in one of nRaces races.
+##
+################################################################################
+def makeEvent(filename, nVehicles, nRaces, seed=0):
+    rng = random.Random(seed)
+    vehicles = [str(uuid.UUID(int=rng.getrandbits(128))) for i in range(0, nVehicles)]
+    races = [[] for i in range(0, nRaces)]
+
+    fh = open(filename, 'w')
+    print >>fh, '# snapshot 1.000000'
+    print >>fh
+    for i in range(0, nVehicles):
+        print >>fh, '[VEHICLE]'
+        print >>fh, 'uuid = %s'%vehicles[i]
+        print >>fh, 'vin = car%05d'%i
+        print >>fh, 'owner = owner %05d'%i
+        print >>fh, 'group = group %d'%(i % nRaces)
+        print >>fh
+        races[i % nRaces].append(vehicles[i])
+    for i in range(0, nRaces):
+        print >>fh, '[RACE]'
+        print >>fh, 'uuid = %s'%uuid.UUID(int=rng.getrandbits(128))
+        print >>fh, 'title = race %d'%i
+        print >>fh, 'lanes = %d'%rng.randint(2, 6)
+        print >>fh, 'rounds = 1'
+        for v in races[i]:
+            print >>fh, 'vehicle = %s'%v
+        print >>fh
+    fh.close()
+
+##############################################################################
+##
+##  main
+##
+##############################################################################
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--vehicles', type='int', default=10000)
+    parser.add_option('--races', type='int', default=50)
+    parser.add_option('--repeat', type='int', default=5,
+            help="loads to time, the fastest is reported")
+    parser.add_option('--backend', choices=('store', 'text'), default='store')
+    (opts, args) = parser.parse_args()
+
+    appdir = tempfile.mkdtemp()
+    derby = {}
+    try:
+        derby = loadDerby(appdir)
+        filename = os.path.join(appdir, 'event.cfg')
+        makeEvent(filename, opts.vehicles, opts.races)
+
+        # The store is filled from the text file by a first read
+        store = None
+        if opts.backend == 'store':
+            store = derby['derbydata'].Database(os.path.join(appdir, 'event.db'))
+            cfg = derby['Config'](filename, store=store)
+            derby['cfg'] = cfg
+            cfg.read()
+            cfg.flush()
+
+        best = None
+        for n in range(0, opts.repeat):
+            cfg = derby['Config'](filename, store=store)
+            derby['cfg'] = cfg
+            start = time.time()
+            cfg.read()
+            elapsed = time.time() - start
+            best = min(best or elapsed, elapsed)
+
+        entered = sum([len(race.vehicles) for race in cfg.races.values()])
+        print "%d vehicles, %d races, %d entries, %d bytes"%(len(cfg.vehicles),
+                len(cfg.races), entered, os.path.getsize(filename))
+        print "Config.read (%s): %.3fs (best of %d)"%(opts.backend, best, opts.repeat)
+    finally:
+        # Let the log writer finish before the directory goes
+        if 'log' in derby:
+            derby['log'].flush()
+        shutil.rmtree(appdir)
@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+################################################################################
+##
+##  csvbench.py
+##
+##  Times a vehicle CSV import, by default 10000 rows: the csvimport thread
+##  on its own, then ManageVehicles.importCsv in derby.py end to end, with
+##  its progress polls, the vehicles being added, the config write and the
+##  render. derby.py is loaded with the stand-ins from cfgbench.py, plus a
+##  window whose timers run in turn and a document of plain elements.
+##
+##  csvbench.py
+##  csvbench.py --rows 50000 --bad 0.01
+##
+################################################################################
+import heapq
+import optparse
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import cfgbench
+import csvimport
+
+class Element(object):
+    innerHTML = ''
+    scrollTop = 0
+    length    = 0
+
+    # Found by tag there's nothing
+    def getElementsByTagName(self, tag):
+        return Element()
+
+class Document(object):
+    def __init__(self):
+        self.elements = {}
+
+    def getElementById(self, elementId):
+        return self.elements.setdefault(elementId, Element())
+
+class Window(object):
+    def __init__(self):
+        self.timers = []
+        self.count  = 0
+        self.alerts = []
+
+    def setTimeout(self, callback, ms):
+        self.count += 1
+        heapq.heappush(self.timers, (time.time() + ms / 1000.0, self.count, callback))
+
+    def alert(self, msg):
+        self.alerts.append(msg)
+
+    # Runs the timers as they come due, and the ones they set, until there
+    # are none
+    def run(self):
+        polls = 0
+        while self.timers:
+            (due, n, callback) = heapq.heappop(self.timers)
+            time.sleep(max(0, due - time.time()))
+            callback()
+            polls += 1
+        return polls
+
+################################################################################
+##
+##  makeCsv
+##  Writes nRows vehicles, a fraction bad of them with a missing column or
+##  a repeated vehicle ID.
+##
+################################################################################
+def makeCsv(filename, nRows, bad=0.0, seed=0):
+    rng = random.Random(seed)
+    groups = ('Tiger', 'Wolf', 'Bear', 'Webelos', 'Open')
+    fh = open(filename, 'wb')
+    for i in range(0, nRows):
+        group = rng.choice(groups)
+        vin = '%s%05d'%(group[0], i)
+        if rng.random() < bad:
+            if rng.random() < 0.5:
+                fh.write('"%s","Owner, %05d"\r\n'%(vin, i))
+                continue
+            vin = '%s%05d'%(group[0], rng.randrange(0, i + 1))
+        fh.write('"%s","Owner, %05d","%s"\r\n'%(vin, i, group))
+    fh.close()
+
+##############################################################################
+##
+##  main
+##
+##############################################################################
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--rows', type='int', default=10000)
+    parser.add_option('--bad', type='float', default=0.0,
+            help="fraction of rows that are bad")
+    parser.add_option('--repeat', type='int', default=3,
+            help="parses to time, the fastest is reported")
+    (opts, args) = parser.parse_args()
+
+    appdir = tempfile.mkdtemp()
+    derby = {}
+    try:
+        filename = os.path.join(appdir, 'vehicles.csv')
+        makeCsv(filename, opts.rows, opts.bad)
+
+        best = None
+        for n in range(0, opts.repeat):
+            imp = csvimport.Importer([filename], known=())
+            imp.start()
+            imp.thread.join()
+            best = min(best or imp.elapsed, imp.elapsed)
+        print "%d rows, %d bytes, %d errors"%(opts.rows, os.path.getsize(filename), len(imp.errors))
+        print "Importer: %.3fs, %d rows/s (best of %d)"%(best, opts.rows / max(best, 0.000001), opts.repeat)
+
+        derby = cfgbench.loadDerby(appdir)
+        derby['window'] = Window()
+        derby['document'] = Document()
+        derby['contentView'].document = derby['document']
+        # Written out as it's logged, so the log's timer doesn't add to
+        # the time window.run() takes
+        derby['log'].DELAY = 0
+        page = derby['manageVehicles']
+
+        start = time.time()
+        page.importCsv([filename])
+        polls = derby['window'].run()
+        elapsed = time.time() - start
+        derby['cfg'].flush()
+        print "importCsv: %.3fs, %d rows/s, %d polls, %d vehicles, %d alerts"%(elapsed,
+                opts.rows / elapsed, polls, len(derby['cfg'].vehicles), len(derby['window'].alerts))
+    finally:
+        if 'log' in derby:
+            derby['log'].flush()
+        shutil.rmtree(appdir)
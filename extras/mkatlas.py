@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+################################################################################
+##
+##  mkatlas.py
+##
+##  Builds Resources/ppnatlas.bin, the precomputed schedules loaded by
+##  derby.py. Rerun it whenever ppngen changes the schedules it generates.
+##
+##  mkatlas.py                       lanes 2-6, cars 2-200, one round
+##  mkatlas.py --rounds 1:2 --output /tmp/ppnatlas.bin
+##
+################################################################################
+import optparse
+import os
+import os.path
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESDIR = os.path.normpath(os.path.join(HERE, '..', 'DerbyRunner', 'Resources'))
+sys.path.insert(0, RESDIR)
+import ppnatlas
+
+def parseRange(txt):
+    if ':' in txt:
+        (lo, hi) = txt.split(':')
+        return range(int(lo), int(hi) + 1)
+    return [int(x) for x in txt.split(',')]
+
+##############################################################################
+##
+##  main
+##
+##############################################################################
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--lanes', default='2:6', help="lanes, e.g. 2:6 or 4,6")
+    parser.add_option('--cars', default='2:200', help="cars, e.g. 2:200 or 50,100")
+    parser.add_option('--rounds', default='1', help="rounds, e.g. 1 or 1:4")
+    parser.add_option('--output', default=os.path.join(RESDIR, 'ppnatlas.bin'))
+    (opts, args) = parser.parse_args()
+
+    lanes = parseRange(opts.lanes)
+    cars = parseRange(opts.cars)
+    weights = [(w, w, w) for w in ppnatlas.PRESETS]
+
+    def progress(nLanes, nCars):
+        if nCars == cars[-1]:
+            print "%d lanes done"%nLanes
+            sys.stdout.flush()
+
+    start = time.time()
+    atlas = ppnatlas.PpnAtlas.build(lanes, cars, parseRange(opts.rounds), weights, progress)
+    atlas.save(opts.output)
+    print "%d schedules, %d bytes, %.1fs -> %s"%(atlas.nEntries,
+            os.path.getsize(opts.output), time.time() - start, opts.output)
@@ -0,0 +1,285 @@
+#! /usr/bin/env python
+################################################################################
+##
+##  ppnbench.py
+##
+##  Times ppngen.Ppn over lanes x cars x weight presets and checks the
+##  results against a stored baseline. Each case runs in a fresh child
+##  process, where fork is available, so its peak memory can be read from
+##  getrusage.
+##
+##  Every run also times a fixed workload that doesn't use ppngen, its
+##  unit. Baseline times are scaled by the ratio of the two units before
+##  comparing, so a baseline saved on one machine still means something
+##  on another. The default sweep takes a spread of car counts; give
+##  --cars 2:200 for all of them.
+##
+##  ppnbench.py                      run the sweep, compare to the baseline
+##  ppnbench.py --save-baseline      run the sweep, store it as the baseline
+##  ppnbench.py --cars 150:200 --lanes 6 --numpy
+##
+################################################################################
+import json
+import optparse
+import os
+import os.path
+import resource
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'DerbyRunner', 'Resources'))
+import ppngen
+
+BASELINE = os.path.join(HERE, 'ppnbench-baseline.json')
+
+PRESETS = {
+    'ZERO'   : ppngen.Weight.ZERO,
+    'LIGHT'  : ppngen.Weight.LIGHT,
+    'MEDIUM' : ppngen.Weight.MEDIUM,
+    'HEAVY'  : ppngen.Weight.HEAVY,
+}
+
+PHASES = ('getParms', 'makeBase', 'orderRaces', 'makeHeats')
+
+################################################################################
+##
+##  rssKb
+##  Current resident size in KB, falling back to the peak where /proc
+##  isn't available.
+##
+################################################################################
+def rssKb():
+    try:
+        fh = open('/proc/self/statm')
+        pages = int(fh.read().split()[1])
+        fh.close()
+        return pages * resource.getpagesize() / 1024
+    except (IOError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+################################################################################
+##
+##  calibrate
+##  Seconds a fixed pure Python workload takes, best of repeat
+##
+################################################################################
+def calibrate(repeat=5):
+    best = None
+    for n in range(0, repeat):
+        t0 = time.time()
+        sums = [0] * 64
+        for i in xrange(0, 300000):
+            sums[i & 63] += (i * i) % 7
+        sorted(sums * 1000)
+        elapsed = time.time() - t0
+        best = min(best or elapsed, elapsed)
+    return round(best, 6)
+
+################################################################################
+##
+##  runCase
+##
+################################################################################
+def runCase(args):
+    (nLanes, nCars, preset, useNumpy, repeat) = args
+    start = rssKb()
+
+    # Best of repeat runs, to keep noise out of the short cases
+    best = None
+    for n in range(0, repeat):
+        ppn = ppngen.Ppn(nLanes, nCars)
+        ppn.W1 = ppn.W2 = ppn.W3 = PRESETS[preset]
+        ppn.useNumpy = useNumpy
+
+        t0 = time.time()
+        parms = ppn.getParms()
+        t1 = time.time()
+        ppn.makeBase(parms)
+        t2 = time.time()
+        ppn.orderRaces()
+        t3 = time.time()
+        ppn.makeHeats()
+        t4 = time.time()
+
+        times = (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t4 - t0)
+        if best is None:
+            best = times
+        best = [min(x) for x in zip(best, times)]
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    case = dict(zip(PHASES + ('wall',), [round(x, 6) for x in best]))
+    case.update({
+        'lanes'  : nLanes,
+        'cars'   : nCars,
+        'preset' : preset,
+        'peakKb' : max(0, peak - start),
+    })
+    return case
+
+################################################################################
+##
+##  forkCase
+##  Runs one case in a forked child and reads its results back through a
+##  pipe.
+##
+################################################################################
+def forkCase(args):
+    if not hasattr(os, 'fork'):
+        return runCase(args)
+
+    (rd, wr) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rd)
+        status = 1
+        try:
+            txt = json.dumps(runCase(args))
+            while txt:
+                txt = txt[os.write(wr, txt):]
+            status = 0
+        finally:
+            os._exit(status)
+
+    os.close(wr)
+    chunks = []
+    while True:
+        chunk = os.read(rd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(rd)
+    (pid, status) = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError("Case %s failed"%(args,))
+    return json.loads(''.join(chunks))
+
+################################################################################
+##
+##  writeResults
+##  JSON with one case per line, so baselines diff sensibly.
+##
+################################################################################
+def writeResults(results, filename):
+    fh = open(filename, 'w')
+    fh.write('{\n')
+    for key in sorted(results):
+        if key != 'cases':
+            fh.write(' %s: %s,\n'%(json.dumps(key), json.dumps(results[key])))
+    fh.write(' "cases": [\n  ')
+    fh.write(',\n  '.join([json.dumps(case, sort_keys=True) for case in results['cases']]))
+    fh.write('\n ]\n}\n')
+    fh.close()
+
+def caseKey(case):
+    return '%d,%d,%s'%(case['lanes'], case['cars'], case['preset'])
+
+# A comma separated list of numbers and lo:hi ranges
+def parseRange(txt):
+    out = []
+    for part in txt.split(','):
+        if ':' in part:
+            (lo, hi) = part.split(':')
+            out.extend(range(int(lo), int(hi) + 1))
+        else:
+            out.append(int(part))
+    return out
+
+################################################################################
+##
+##  compare
+##  A case regresses when a time grows past tolerance times the baseline,
+##  scaled to this machine, plus slack seconds, or its peak memory grows
+##  past memTolerance times the baseline plus memSlack KB.
+##
+################################################################################
+def compare(results, baseline, opts):
+    old = dict([(caseKey(case), case) for case in baseline['cases']])
+    scale = 1.0
+    if baseline.get('unit') and results.get('unit'):
+        scale = results['unit'] / baseline['unit']
+    failures = []
+    for case in results['cases']:
+        base = old.get(caseKey(case))
+        if base is None:
+            continue
+        for metric in PHASES + ('wall',):
+            limit = (base[metric] * scale * opts.tolerance) + opts.slack
+            if case[metric] > limit:
+                failures.append('%-14s %-10s %.4fs > %.4fs (baseline %.4fs)'%(
+                    caseKey(case), metric, case[metric], limit, base[metric]))
+        limit = (base['peakKb'] * opts.memTolerance) + opts.memSlack
+        if case['peakKb'] > limit:
+            failures.append('%-14s %-10s %dKB > %dKB (baseline %dKB)'%(
+                caseKey(case), 'peakKb', case['peakKb'], limit, base['peakKb']))
+    return failures
+
+##############################################################################
+##
+##  main
+##
+##############################################################################
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--lanes', default='2:6', help="lanes, e.g. 2:6 or 4,6")
+    parser.add_option('--cars', default='2:12,16,20,25,32,40,50,64,80,100,128,160,200',
+            help="cars, e.g. 2:200 or 2:10,50,100")
+    parser.add_option('--presets', default='ZERO,LIGHT,MEDIUM,HEAVY')
+    parser.add_option('--numpy', action='store_true', default=False,
+            help="order heats with NumPy")
+    parser.add_option('--output', default='ppnbench.json',
+            help="where to write the results")
+    parser.add_option('--baseline', default=BASELINE)
+    parser.add_option('--save-baseline', dest='save', action='store_true',
+            default=False, help="store the results as the new baseline")
+    parser.add_option('--repeat', type='int', default=3,
+            help="runs per case, the fastest is kept")
+    parser.add_option('--tolerance', type='float', default=1.5)
+    parser.add_option('--slack', type='float', default=0.01)
+    parser.add_option('--mem-tolerance', dest='memTolerance', type='float', default=1.25)
+    parser.add_option('--mem-slack', dest='memSlack', type='int', default=1024)
+    (opts, args) = parser.parse_args()
+
+    # Compile the parameter table once, before the children fork
+    ppngen.parmTable()
+
+    cases = []
+    for nLanes in parseRange(opts.lanes):
+        for nCars in parseRange(opts.cars):
+            for preset in opts.presets.split(','):
+                cases.append((nLanes, nCars, preset, opts.numpy, opts.repeat))
+
+    # One process per case, one at a time, so the timings don't compete
+    start = time.time()
+    results = {
+        'python'  : sys.version.split()[0],
+        'numpy'   : opts.numpy,
+        'unit'    : calibrate(),
+        'cases'   : [forkCase(case) for case in cases],
+    }
+    results['total'] = round(time.time() - start, 1)
+
+    writeResults(results, opts.output)
+    print "%d cases in %.1fs, results in %s"%(len(cases), results['total'], opts.output)
+
+    if opts.save:
+        writeResults(results, opts.baseline)
+        print "Baseline saved to %s"%opts.baseline
+        sys.exit(0)
+
+    try:
+        fh = open(opts.baseline)
+        baseline = json.load(fh)
+        fh.close()
+    except IOError, e:
+        print "No baseline to compare with: %s"%e
+        sys.exit(0)
+
+    failures = compare(results, baseline, opts)
+    if failures:
+        print
+        print "*** %d REGRESSIONS against %s ***"%(len(failures), opts.baseline)
+        for txt in failures:
+            print txt
+        sys.exit(1)
+    print "No regressions against %s"%opts.baseline